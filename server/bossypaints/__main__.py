@@ -0,0 +1,22 @@
+import argparse
+
+
+def warmup():
+    """Compile the rasterization kernels so their on-disk cache is populated."""
+    from bossypaints import _raster
+
+    _raster.warmup()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bossypaints")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("warmup", help="Compile and cache the polygon rasterization kernels")
+    args = parser.parse_args()
+
+    if args.command == "warmup":
+        warmup()
+
+
+if __name__ == "__main__":
+    main()
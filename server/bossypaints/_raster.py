@@ -0,0 +1,367 @@
+"""
+Numba kernels for rasterizing annotation polygons directly into label volumes.
+
+The kernels use a scanline fill: for every row of the output, the
+x-intersections with the polygon edges are computed, sorted, and the spans
+between each pair are written in one slice assignment. Volumes are laid out
+(z, y, x) in C order, so every span is a contiguous run of memory. No intermediate
+coordinate arrays are allocated, rows are filled in parallel, and all of the
+polygons on a slice are drawn in a single call.
+
+A polygon's outer boundaries and holes are filled together: each row's spans
+are computed for both, and only the parts of the outer spans outside the hole
+spans are written, so the pixels in a hole are never drawn and then cleared.
+Each ring is filled even-odd on its own and the rings are combined as a union,
+the way the frontend treats a polygon's regions.
+
+Run `python -m bossypaints warmup` once after installation so that the compiled
+kernels are cached on disk and the first render does not pay the JIT cost.
+"""
+import math
+
+import numpy as np
+from numba import njit, prange
+
+# How `_row_spans` counts edges and rounds spans. A pixel is inside a ring if
+# the ring crosses an odd number of times either to its right, counting edges on
+# rows [y_low, y_high), or to its left, counting edges on rows (y_low, y_high]
+# (or if it is a vertex). On rows without a vertex both counts see the same
+# crossings, so one closed pass covers both.
+_CLOSED = 0
+_RIGHT = 1
+_LEFT = 2
+
+
+@njit(cache=True, inline="always")
+def _merge_spans(starts, stops, count, ordered):
+    """Merge closed spans that overlap or meet, in place. Returns how many are left.
+
+    Unless `ordered`, the spans are sorted by their start first.
+
+    """
+    if not ordered:
+        # Span lists are short, so insertion sort beats a general sort
+        for a in range(1, count):
+            x0, x1 = starts[a], stops[a]
+            b = a - 1
+            while b >= 0 and starts[b] > x0:
+                starts[b + 1] = starts[b]
+                stops[b + 1] = stops[b]
+                b -= 1
+            starts[b + 1] = x0
+            stops[b + 1] = x1
+
+    merged = 0
+    for k in range(count):
+        if merged > 0 and starts[k] <= stops[merged - 1] + 1:
+            stops[merged - 1] = max(stops[merged - 1], stops[k])
+        else:
+            starts[merged] = starts[k]
+            stops[merged] = stops[k]
+            merged += 1
+    return merged
+
+
+@njit(cache=True, inline="always")
+def _row_spans(edges, edge_offsets, y, mode, x_size, crossings, starts, stops):
+    """Compute the spans of row `y` inside any of the rings that `edges` belong to.
+
+    Ring i's edges are `edges[edge_offsets[i]:edge_offsets[i + 1]]`. Each ring
+    is filled even-odd on its own, and the rings are combined as a union, so
+    overlapping rings do not cancel out. `mode` is one of `_CLOSED`, `_RIGHT`
+    and `_LEFT`, and sets which edges are counted and which span ends are
+    kept. Spans are closed on both ends and clipped to [0, x_size - 1]; they
+    are written, sorted and disjoint, to `starts`/`stops`; `crossings` is
+    scratch space with room for one value per edge. Returns the number of spans.
+
+    """
+    spans = 0
+    for r in range(edge_offsets.shape[0] - 1):
+        count = 0
+        for e in range(edge_offsets[r], edge_offsets[r + 1]):
+            if edges[e, 1] > y:
+                break
+            if mode == _LEFT:
+                if y <= edges[e, 1] or y > edges[e, 3]:
+                    continue
+            elif y >= edges[e, 3]:
+                continue
+            crossings[count] = edges[e, 0] + (y - edges[e, 1]) * (edges[e, 2] - edges[e, 0]) / (
+                edges[e, 3] - edges[e, 1]
+            )
+            count += 1
+
+        for a in range(1, count):
+            value = crossings[a]
+            b = a - 1
+            while b >= 0 and crossings[b] > value:
+                crossings[b + 1] = crossings[b]
+                b -= 1
+            crossings[b + 1] = value
+
+        for k in range(0, count - 1, 2):
+            low = crossings[k]
+            high = crossings[k + 1]
+            if mode == _CLOSED:
+                # Two edges crossing at one point enclose nothing
+                if low == high:
+                    continue
+                x0, x1 = int(math.ceil(low)), int(math.floor(high))
+            elif mode == _RIGHT:
+                x0, x1 = int(math.ceil(low)), int(math.ceil(high)) - 1
+            else:
+                x0, x1 = int(math.floor(low)) + 1, int(math.floor(high))
+            x0 = max(0, x0)
+            x1 = min(x_size - 1, x1)
+            if x0 <= x1:
+                starts[spans] = x0
+                stops[spans] = x1
+                spans += 1
+
+    # Spans of different rings can come in any order
+    return _merge_spans(starts, stops, spans, edge_offsets.shape[0] <= 2)
+
+
+@njit(cache=True, inline="always")
+def _class_spans(edges, edge_offsets, vertex_ys, vertex_xs, y, on_vertex, x_size, crossings, starts, stops):
+    """Compute the spans of row `y` inside the outer rings (or the holes) of a polygon.
+
+    `vertex_ys`/`vertex_xs` are the rings' integer vertices, sorted by y.
+    `starts`/`stops` are (3, M) scratch arrays; the spans are written to
+    `starts[2]`/`stops[2]`. Returns the number of spans.
+
+    """
+    if not on_vertex:
+        return _row_spans(edges, edge_offsets, y, _CLOSED, x_size, crossings, starts[2], stops[2])
+
+    count_right = _row_spans(edges, edge_offsets, y, _RIGHT, x_size, crossings, starts[0], stops[0])
+    count_left = _row_spans(edges, edge_offsets, y, _LEFT, x_size, crossings, starts[1], stops[1])
+    count = _union_spans(starts[0], stops[0], count_right, starts[1], stops[1], count_left, starts[2], stops[2])
+
+    # Vertices are inside their rings even where the crossing counts miss them
+    merged = count
+    for v in range(np.searchsorted(vertex_ys, y), vertex_ys.shape[0]):
+        if vertex_ys[v] != y:
+            break
+        x = vertex_xs[v]
+        if 0 <= x < x_size:
+            starts[2, count] = x
+            stops[2, count] = x
+            count += 1
+    if count > merged:
+        count = _merge_spans(starts[2], stops[2], count, False)
+    return count
+
+
+@njit(cache=True)
+def _union_spans(starts_a, stops_a, count_a, starts_b, stops_b, count_b, starts, stops):
+    """Merge two sorted lists of disjoint closed spans into their union. Returns its length."""
+    i = j = count = 0
+    while i < count_a or j < count_b:
+        if j >= count_b or (i < count_a and starts_a[i] <= starts_b[j]):
+            x0, x1 = starts_a[i], stops_a[i]
+            i += 1
+        else:
+            x0, x1 = starts_b[j], stops_b[j]
+            j += 1
+        if count > 0 and x0 <= stops[count - 1] + 1:
+            stops[count - 1] = max(stops[count - 1], x1)
+        else:
+            starts[count] = x0
+            stops[count] = x1
+            count += 1
+    return count
+
+
+@njit(cache=True)
+def _ring_edges(poly_xy, ring_offsets, ring_holes, holes):
+    """Return the edges and integer vertices of the outer rings (or, if `holes`, of the hole rings).
+
+    Edges are (x_low, y_low, x_high, y_high) rows, grouped by ring and sorted by
+    their min-y within each ring, and come with the (K + 1,) offsets of the K
+    rings' groups. The vertices with integer coordinates are returned as
+    separate y and x arrays, sorted by y.
+
+    """
+    n = 0
+    k = 0
+    for r in range(ring_offsets.shape[0] - 1):
+        if ring_holes[r] == holes:
+            n += ring_offsets[r + 1] - ring_offsets[r]
+            k += 1
+
+    edges = np.empty((n, 4), dtype=np.float64)
+    edge_offsets = np.zeros(k + 1, dtype=np.int64)
+    vertex_ys = np.empty(n, dtype=np.int64)
+    vertex_xs = np.empty(n, dtype=np.int64)
+    e = 0
+    k = 0
+    v = 0
+    for r in range(ring_offsets.shape[0] - 1):
+        if ring_holes[r] != holes:
+            continue
+        ring_start = ring_offsets[r]
+        ring_stop = ring_offsets[r + 1]
+        for i in range(ring_start, ring_stop):
+            j = i - 1 if i > ring_start else ring_stop - 1
+            if poly_xy[i, 1] <= poly_xy[j, 1]:
+                edges[e, 0], edges[e, 1] = poly_xy[i, 0], poly_xy[i, 1]
+                edges[e, 2], edges[e, 3] = poly_xy[j, 0], poly_xy[j, 1]
+            else:
+                edges[e, 0], edges[e, 1] = poly_xy[j, 0], poly_xy[j, 1]
+                edges[e, 2], edges[e, 3] = poly_xy[i, 0], poly_xy[i, 1]
+            e += 1
+            if poly_xy[i, 0] == math.floor(poly_xy[i, 0]) and poly_xy[i, 1] == math.floor(poly_xy[i, 1]):
+                vertex_xs[v] = int(poly_xy[i, 0])
+                vertex_ys[v] = int(poly_xy[i, 1])
+                v += 1
+        group = edges[edge_offsets[k] : e]
+        group[:] = group[np.argsort(group[:, 1])]
+        k += 1
+        edge_offsets[k] = e
+
+    order = np.argsort(vertex_ys[:v])
+    return edges, edge_offsets, vertex_ys[:v][order], vertex_xs[:v][order]
+
+
+@njit(cache=True, parallel=True)
+def fill_polygon_scanline(volume, poly_xy, ring_offsets, ring_holes, z, seg_id, x_size, y_size):
+    """Fill a polygon into `volume[z]` with the value `seg_id`.
+
+    A pixel is filled if its (integer) coordinates lie inside or on the
+    boundary of any of the polygon's outer boundaries, and neither inside nor
+    on the boundary of any of its holes. Each ring is filled the way
+    `skimage.draw.polygon` fills it, and the rings are combined as a union, so
+    overlapping rings never cancel out: a square with corners at 10 and 20
+    fills 11 x 11 pixels. Pixels outside the volume are dropped, as with
+    `skimage.draw.polygon(..., shape=...)`, not moved to its edge.
+
+    Arguments:
+        - volume: (z, y, x) array to write into.
+        - poly_xy: (N, 2) array of vertices, already scaled to the task resolution
+          and offset to be relative to the task bounds.
+        - ring_offsets: (R + 1,) array; ring i of the polygon (an outer boundary or
+          a hole) is `poly_xy[ring_offsets[i]:ring_offsets[i + 1]]`.
+        - ring_holes: (R,) array; nonzero where ring i is a hole.
+        - z: Index of the slice to write.
+        - seg_id: Value to write for every pixel inside the polygon.
+        - x_size, y_size: Bounds of the volume; pixels outside are dropped.
+
+    Returns the number of pixels written.
+
+    """
+    first_vertex = ring_offsets[0]
+    n = ring_offsets[-1] - first_vertex
+
+    outer_edges, outer_offsets, outer_vertex_ys, outer_vertex_xs = _ring_edges(poly_xy, ring_offsets, ring_holes, False)
+    hole_edges, hole_offsets, hole_vertex_ys, hole_vertex_xs = _ring_edges(poly_xy, ring_offsets, ring_holes, True)
+
+    ys = poly_xy[first_vertex : first_vertex + n, 1]
+    y_start = max(0, int(math.ceil(ys.min())))
+    y_stop = min(y_size - 1, int(math.floor(ys.max())))
+    if y_start > y_stop:
+        return 0
+
+    # Rows through a vertex are where the two crossing counts can disagree, so
+    # only those rows need both passes
+    vertex_rows = np.zeros(y_stop - y_start + 1, dtype=np.bool_)
+    for i in range(first_vertex, first_vertex + n):
+        vy = poly_xy[i, 1]
+        if vy == math.floor(vy) and y_start <= vy <= y_stop:
+            vertex_rows[int(vy) - y_start] = True
+
+    written = 0
+    for y in prange(y_start, y_stop + 1):
+        on_vertex = vertex_rows[y - y_start]
+        crossings = np.empty(n, dtype=np.float64)
+        # Each pass gives at most n / 2 spans, and each vertex one more
+        spans = np.empty((12, 2 * n + 1 if on_vertex else n // 2 + 1), dtype=np.int64)
+        starts, stops = spans[:6], spans[6:]
+
+        count = _class_spans(
+            outer_edges, outer_offsets, outer_vertex_ys, outer_vertex_xs, y, on_vertex, x_size, crossings, starts[:3], stops[:3]
+        )
+        fill_starts, fill_stops = starts[2], stops[2]
+
+        hole_count = 0
+        hole_starts, hole_stops = starts[5], stops[5]
+        if hole_edges.shape[0] > 0:
+            hole_count = _class_spans(
+                hole_edges, hole_offsets, hole_vertex_ys, hole_vertex_xs, y, on_vertex, x_size, crossings, starts[3:], stops[3:]
+            )
+
+        # Write each span with the holes cut out of it
+        h = 0
+        for k in range(count):
+            x0 = fill_starts[k]
+            x1 = fill_stops[k]
+            while h < hole_count and hole_stops[h] < x0:
+                h += 1
+            g = h
+            while x0 <= x1:
+                if g < hole_count and hole_starts[g] <= x1:
+                    if hole_starts[g] > x0:
+                        volume[z, y, x0 : hole_starts[g]] = seg_id
+                        written += hole_starts[g] - x0
+                    x0 = max(x0, hole_stops[g] + 1)
+                    g += 1
+                else:
+                    volume[z, y, x0 : x1 + 1] = seg_id
+                    written += x1 - x0 + 1
+                    break
+
+    return written
+
+
+@njit(cache=True)
+def fill_polygons_scanline(volume, poly_xy, ring_offsets, ring_holes, polygon_offsets, values, z, x_size, y_size):
+    """Fill a batch of polygons into `volume[z]`, in order.
+
+    Drawing a whole slice in one call amortizes the Python-to-native transition
+    over every polygon on that slice.
+
+    Arguments:
+        - volume: (z, y, x) array to write into.
+        - poly_xy: (N, 2) array of transformed vertices; rings are concatenated.
+        - ring_offsets: (R + 1,) array; ring i is `poly_xy[ring_offsets[i]:ring_offsets[i + 1]]`.
+        - ring_holes: (R,) array; nonzero where ring i is a hole.
+        - polygon_offsets: (P + 1,) array; polygon i is made of rings
+          `polygon_offsets[i]` up to (excluding) `polygon_offsets[i + 1]`.
+        - values: (P,) array with the value to write for each polygon.
+        - z, x_size, y_size: As in `fill_polygon_scanline`.
+
+    Returns the number of pixels written.
+
+    """
+    written = 0
+    for i in range(polygon_offsets.shape[0] - 1):
+        written += fill_polygon_scanline(
+            volume,
+            poly_xy,
+            ring_offsets[polygon_offsets[i] : polygon_offsets[i + 1] + 1],
+            ring_holes[polygon_offsets[i] : polygon_offsets[i + 1]],
+            z,
+            values[i],
+            x_size,
+            y_size,
+        )
+    return written
+
+
+def warmup():
+    """Compile the kernels for the argument types used by the renderer.
+
+    Compiled kernels are cached next to this module, so later processes load
+    them from disk instead of recompiling.
+
+    """
+    poly_xy = np.array([[0.0, 0.0], [2.0, 0.0], [2.0, 2.0], [0.0, 2.0]])
+    ring_offsets = np.array([0, 4])
+    ring_holes = np.array([False])
+    polygon_offsets = np.array([0, 1])
+    # Label volumes use the smallest dtype that fits their seg IDs; masks are
+    # uint8. Each dtype is a separate specialization.
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        target = np.zeros((1, 4, 4), dtype=dtype)
+        values = np.array([1], dtype=dtype)
+        fill_polygons_scanline(target, poly_xy, ring_offsets, ring_holes, polygon_offsets, values, 0, 4, 4)
@@ -1,3 +1,12 @@
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
 from zmesh import Mesher
 from intern import array as intern_array
 
@@ -8,6 +17,8 @@ from bossypaints.renderer import (
 from bossypaints.tasks import JSONFileTaskQueueStore, Task, TaskID
 from bossypaints.checkpoints import Checkpoint, JSONCheckpointStore
 
+logger = logging.getLogger(__name__)
+
 def render_and_mesh(task_id: str, task: Task, checkpoints: list[Checkpoint]):
     # if task.destination_collection and task.destination_experiment and task.destination_channel:
     #     BossDBInternVolumePolygonRenderer().render_from_checkpoints(
@@ -20,19 +31,142 @@ def render_and_mesh(task_id: str, task: Task, checkpoints: list[Checkpoint]):
     )
     isvpr.render_from_checkpoints(task, checkpoints)
     # Also trigger mesh generation.
-    # First, we need to get the voxel shapes.
-    print(intern_array(
-        f"bossdb://{task.destination_collection}/{task.destination_experiment}/{task.destination_channel}"
-    ).voxel_size)
-    mesher = Mesher((1,1,1)) # TODO: Get the resolution from the task
-    vols = isvpr._materialize_xyz_volume(task, checkpoints, as_channels=True)
-    # vols = (x, y, z, C)
-    for c in range(vols.shape[-1]):
-        vol = vols[:, :, :, c]
-        mesher.mesh(vol, close=False)
-        for objid in mesher.ids():
-            mesh = mesher.get(objid, normals=False,
-                            # reduction_factor=10, max_error=2
-                            )
-            with open(f"./exports/{task_id}/{objid}.obj", "wb") as f:
-                f.write(mesh.to_obj())
+    # First, we need to get the voxel shapes. Opening the array is a round trip
+    # to BossDB, so it is only made when the voxel size is actually logged.
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Voxel size: %s", intern_array(
+            f"bossdb://{task.destination_collection}/{task.destination_experiment}/{task.destination_channel}"
+        ).voxel_size)
+    # Mesh one seg ID at a time from its own contiguous 0/1 mask. Masks are
+    # independent, so they are meshed in parallel on a process pool while the
+    # next ones are rasterized; at most two masks per worker are in flight, to
+    # keep peak memory bounded.
+    executor = _get_mesh_executor()
+    pending = {}
+    try:
+        for seg_id, mask in isvpr._materialize_zyx_masks(task, checkpoints):
+            if len(pending) >= 2 * _MESH_WORKERS:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _write_obj(task_id, pending.pop(future), future.result())
+            pending[executor.submit(_mesh_mask, mask)] = seg_id
+        for future, seg_id in pending.items():
+            _write_obj(task_id, seg_id, future.result())
+    except BrokenProcessPool:
+        # A worker died; start a fresh pool for the next render
+        shutdown_mesh_executor()
+        raise
+    finally:
+        # If the render failed, don't leave its masks queued on the shared pool
+        for future in pending:
+            future.cancel()
+
+
+# The meshing pool is shared by every render, so its workers (and their imports)
+# are only started once. Workers are started from a fork server, as forking
+# this (threaded) server process directly is unsafe; the fork server imports
+# this module up front, so each worker starts with it already loaded.
+_MESH_WORKERS = os.cpu_count() or 1
+_mesh_executor: ProcessPoolExecutor | None = None
+
+
+def _get_mesh_executor() -> ProcessPoolExecutor:
+    global _mesh_executor
+    if _mesh_executor is None:
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+        _mesh_executor = ProcessPoolExecutor(max_workers=_MESH_WORKERS, mp_context=context)
+    return _mesh_executor
+
+
+def shutdown_mesh_executor() -> None:
+    """Stop the meshing pool's workers. A later render starts a new pool."""
+    global _mesh_executor
+    if _mesh_executor is not None:
+        _mesh_executor.shutdown()
+        _mesh_executor = None
+
+
+# One mesher per worker process, reused (and cleared) for every mask it meshes
+_mesher: Mesher | None = None
+
+
+def _mesh_mask(mask: np.ndarray) -> bytes | None:
+    """Mesh a (z, y, x) 0/1 mask, returning the .obj file contents of its 1s (None if empty)."""
+    global _mesher
+    if _mesher is None:
+        _mesher = Mesher((1,1,1)) # TODO: Get the resolution from the task
+    # The transpose is a zero-copy Fortran-ordered (x, y, z) view, so mesh
+    # vertices stay in x, y, z.
+    _mesher.mesh(mask.T, close=False)
+    obj = None
+    if 1 in _mesher.ids():
+        mesh = _mesher.get(1, normals=False,
+                        # reduction_factor=10, max_error=2
+                        )
+        obj = mesh.to_obj()
+    _mesher.clear()
+    return obj
+
+
+def _write_obj(task_id: str, seg_id: int, obj: bytes | None):
+    if obj is None:
+        return
+    with open(f"./exports/{task_id}/{seg_id}.obj", "wb") as f:
+        f.write(obj)
+
+
+class RenderQueue:
+    """
+    Runs `render_and_mesh` for saved tasks one at a time, off the event loop.
+
+    Each render already uses every core, so running several at once only
+    oversubscribes the machine. Saving a task that is already waiting to be
+    rendered replaces its checkpoints instead of queueing a second render.
+    """
+
+    def __init__(self):
+        self._queue: asyncio.Queue[str] = asyncio.Queue()
+        self._pending: dict[str, tuple[Task, list[Checkpoint]]] = {}
+        self._worker: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._worker = asyncio.create_task(self.run())
+
+    def submit(self, task_id: str, task: Task, checkpoints: list[Checkpoint]) -> None:
+        if task_id not in self._pending:
+            self._queue.put_nowait(task_id)
+        self._pending[task_id] = (task, checkpoints)
+
+    async def run(self) -> None:
+        while True:
+            task_id = await self._queue.get()
+            task, checkpoints = self._pending.pop(task_id)
+            try:
+                await asyncio.to_thread(render_and_mesh, task_id, task, checkpoints)
+            except Exception:
+                logger.exception(f"Rendering task {task_id} failed")
+            finally:
+                self._queue.task_done()
+
+    async def close(self, timeout: float) -> None:
+        """Stop the worker, first giving queued renders up to `timeout` seconds to finish.
+
+        Renders still queued after that are dropped (and logged). A render that
+        is already running cannot be interrupted, so it is always waited for.
+
+        """
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            while not self._queue.empty():
+                task_id = self._queue.get_nowait()
+                self._pending.pop(task_id, None)
+                self._queue.task_done()
+                logger.warning(f"Dropped queued render of task {task_id} at shutdown")
+            await self._queue.join()
+        if self._worker is not None:
+            self._worker.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._worker
+        await asyncio.to_thread(shutdown_mesh_executor)
@@ -1,11 +1,16 @@
+import abc
+from collections import deque
 from typing import Protocol
-import pydantic
-import json
+import os
+import uuid
+
+import msgspec
+import orjson
 
 from bossypaints.tasks import TaskID
 
 
-class Polygon(pydantic.BaseModel):
+class Polygon(msgspec.Struct, kw_only=True, gc=False):
     # Positive/negative regions approach
     positiveRegions: list[list[tuple[float, float]]] = []
     negativeRegions: list[list[tuple[float, float]]] = []
@@ -16,27 +21,29 @@ class Polygon(pydantic.BaseModel):
     z: int
 
 
-class Checkpoint(pydantic.BaseModel):
+class Checkpoint(msgspec.Struct, kw_only=True, gc=False):
     polygons: list[Polygon]
     taskID: TaskID
 
-    # When receiving dict, convert to Polygon
-    @pydantic.validator("polygons", pre=True)
-    def convert_polygons(cls, v):
-        if isinstance(v, list):
-            result = []
-            for polygon in v:
-                if isinstance(polygon, Polygon):
-                    # Already a Polygon object
-                    result.append(polygon)
-                elif isinstance(polygon, dict):
-                    # Dict that needs to be converted
-                    result.append(Polygon(**polygon))
-                else:
-                    # Unexpected type
-                    raise ValueError(f"Polygon must be dict or Polygon object, got {type(polygon)}")
-            return result
-        return v
+
+class _CheckpointRequestBody(msgspec.Struct, gc=False):
+    checkpoint: list[Polygon]
+
+
+_checkpoint_request_decoder = msgspec.json.Decoder(_CheckpointRequestBody)
+
+
+def checkpoint_from_request_body(task_id: TaskID, body: bytes) -> Checkpoint:
+    """Decode a `{"checkpoint": [polygon, ...]}` JSON request body into a Checkpoint.
+
+    The polygons are validated as they are parsed, without building
+    intermediate dicts first.
+
+    Raises msgspec.DecodeError (or its subclass msgspec.ValidationError) if
+    the body is not valid JSON or the polygons are malformed.
+
+    """
+    return Checkpoint(polygons=_checkpoint_request_decoder.decode(body).checkpoint, taskID=task_id)
 
 
 class CheckpointStore(Protocol):
@@ -56,42 +63,89 @@ class CheckpointStore(Protocol):
         """
         ...
 
+    def get_version_for_task(self, task_id: TaskID) -> str:
+        """
+        Get an opaque version string that changes whenever a task's checkpoints change.
+        """
+        ...
+
 
 class InMemoryCheckpointStore(CheckpointStore):
-    def __init__(self):
-        self.checkpoints: dict[TaskID, list[Checkpoint]] = {}
+    def __init__(self, history: int = 50):
+        # Only the latest `history` checkpoints are kept per task
+        self.history = history
+        self.checkpoints: dict[TaskID, deque[Checkpoint]] = {}
+        # Versions restart with every store, so they are scoped by a random epoch
+        self._epoch = uuid.uuid4().hex
+        self._versions: dict[TaskID, int] = {}
 
     def save_checkpoint(self, checkpoint: Checkpoint) -> None:
-        self.checkpoints.setdefault(checkpoint.taskID, []).append(checkpoint)
+        self.checkpoints.setdefault(checkpoint.taskID, deque(maxlen=self.history)).append(checkpoint)
+        self._versions[checkpoint.taskID] = self._versions.get(checkpoint.taskID, 0) + 1
 
     def get_checkpoints_for_task(self, task_id: TaskID) -> list[Checkpoint]:
-        return self.checkpoints.get(task_id, [])
+        return list(self.checkpoints.get(task_id, ()))
+
+    def get_version_for_task(self, task_id: TaskID) -> str:
+        return f"{self._epoch}-{self._versions.get(task_id, 0)}"
 
 
-class JSONCheckpointStore(CheckpointStore):
+class FileCheckpointStore(CheckpointStore, abc.ABC):
+    """
+    A checkpoint store that keeps every task's checkpoints in a single file.
+
+    Subclasses choose the on-disk encoding by implementing `_encode` and `_decode`.
+    """
+
     def __init__(self, filename: str):
         self._filename = filename
+        # The parsed file contents, keyed by the (mtime, size) they were read at.
+        # The file is only re-parsed when it changes on disk.
+        self._cache: tuple[tuple[int, int], dict[TaskID, list[Checkpoint]]] | None = None
+        # Per-task versions, counted from the last time the file was parsed. The
+        # epoch changes with every parse, so versions from before a restart or an
+        # outside change to the file never match.
+        self._epoch = uuid.uuid4().hex
+        self._versions: dict[TaskID, int] = {}
+
+    @abc.abstractmethod
+    def _encode(self, checkpoints: dict[TaskID, list[Checkpoint]]) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    def _decode(self, raw: bytes) -> dict[TaskID, list[Checkpoint]]:
+        pass
+
+    def _file_version(self) -> tuple[int, int]:
+        stat = os.stat(self._filename)
+        return stat.st_mtime_ns, stat.st_size
 
     def _load_latest_from_file(self) -> dict[TaskID, list[Checkpoint]]:
         try:
-            with open(self._filename) as f:
-                json_data = json.load(f)
-            return {
-                task_id: [Checkpoint(**checkpoint) for checkpoint in checkpoints]
-                for task_id, checkpoints in json_data.items()
-            }
+            version = self._file_version()
         except FileNotFoundError:
             return {}
+        if self._cache is not None and self._cache[0] == version:
+            return self._cache[1]
+
+        try:
+            with open(self._filename, "rb") as f:
+                checkpoints = self._decode(f.read())
+        except FileNotFoundError:
+            return {}
+        self._cache = (version, checkpoints)
+        self._epoch = uuid.uuid4().hex
+        self._versions = {}
+        return checkpoints
 
     def _write_to_file(self, checkpoints: dict[TaskID, list[Checkpoint]]) -> None:
-        with open(self._filename, "w") as f:
-            json.dump(
-                {
-                    task_id: [checkpoint.dict() for checkpoint in checkpoints]
-                    for task_id, checkpoints in checkpoints.items()
-                },
-                f,
-            )
+        raw = self._encode(checkpoints)
+        # Write to a temporary file and swap it in, so readers never see a partial file
+        tmp_filename = f"{self._filename}.tmp"
+        with open(tmp_filename, "wb") as f:
+            f.write(raw)
+        os.replace(tmp_filename, self._filename)
+        self._cache = (self._file_version(), checkpoints)
 
     def save_checkpoint(self, checkpoint: Checkpoint) -> None:
         # TODO: Must support deletion and merging of checkpoints.
@@ -100,11 +154,50 @@ class JSONCheckpointStore(CheckpointStore):
         # checkpoints.setdefault(checkpoint.taskID, []).append(checkpoint)
         # self._write_to_file(checkpoints)
 
-        # Replace the checkpoint for the task
-        checkpoints = self._load_latest_from_file()
+        # Replace the checkpoint for the task. Copy the cached dict so it is only
+        # updated once the write has succeeded.
+        checkpoints = dict(self._load_latest_from_file())
         checkpoints[checkpoint.taskID] = [checkpoint]
         self._write_to_file(checkpoints)
+        self._versions[checkpoint.taskID] = self._versions.get(checkpoint.taskID, 0) + 1
 
     def get_checkpoints_for_task(self, task_id: TaskID) -> list[Checkpoint]:
         checkpoints = self._load_latest_from_file()
         return checkpoints.get(task_id, [])
+
+    def get_version_for_task(self, task_id: TaskID) -> str:
+        # Pick up outside changes to the file first
+        self._load_latest_from_file()
+        return f"{self._epoch}-{self._versions.get(task_id, 0)}"
+
+
+class JSONCheckpointStore(FileCheckpointStore):
+    def _encode(self, checkpoints: dict[TaskID, list[Checkpoint]]) -> bytes:
+        return orjson.dumps(msgspec.to_builtins(checkpoints))
+
+    def _decode(self, raw: bytes) -> dict[TaskID, list[Checkpoint]]:
+        return msgspec.convert(orjson.loads(raw), type=dict[TaskID, list[Checkpoint]])
+
+
+class MsgpackCheckpointStore(FileCheckpointStore):
+    """
+    A checkpoint store backed by a MessagePack file.
+
+    Polygon vertices are long arrays of floats, which MessagePack encodes and
+    decodes far faster (and smaller) than JSON. The file is decoded straight
+    into Checkpoint structs, without an intermediate dict.
+    """
+
+    def __init__(self, filename: str, legacy_json_filename: str | None = None):
+        super().__init__(filename)
+        # One-time migration of checkpoints saved by JSONCheckpointStore
+        if legacy_json_filename and not os.path.exists(filename) and os.path.exists(legacy_json_filename):
+            self._write_to_file(JSONCheckpointStore(legacy_json_filename)._load_latest_from_file())
+
+    _decoder = msgspec.msgpack.Decoder(dict[TaskID, list[Checkpoint]])
+
+    def _encode(self, checkpoints: dict[TaskID, list[Checkpoint]]) -> bytes:
+        return msgspec.msgpack.encode(checkpoints)
+
+    def _decode(self, raw: bytes) -> dict[TaskID, list[Checkpoint]]:
+        return self._decoder.decode(raw)
@@ -1,15 +1,19 @@
+import os
 import pathlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import chain
+from typing import Iterator, NamedTuple
 from bossypaints.checkpoints import Checkpoint
 from bossypaints.tasks import TaskInDB
 
-# For rasterizing polys with scikit-image
-from skimage.draw import polygon
-from skimage.io import imsave
 import numpy as np
+import tifffile
 import logging
 
 from intern import array
 
+from bossypaints._raster import fill_polygons_scanline
+
 logger = logging.getLogger(__name__)
 
 
@@ -20,113 +24,261 @@ class VolumePolygonRenderer:
         pass
 
 
+def _label_dtype(max_id: int) -> type[np.unsignedinteger]:
+    """Return the smallest unsigned integer dtype that can hold `max_id`."""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_id <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+class _RegionBatches(NamedTuple):
+    """Polygon regions grouped per slice, ready to hand to the rasterizer."""
+
+    # Sorted unique seg IDs across all polygons
+    ids: list[int]
+    # (z, seg ID or None) -> (start, stop) range of polygons in that batch
+    batches: dict[tuple[int, int | None], tuple[int, int]]
+    # Every ring's vertices, scaled and offset to be relative to the task bounds
+    points: np.ndarray
+    # Ring i is points[ring_offsets[i]:ring_offsets[i + 1]]
+    ring_offsets: np.ndarray
+    # Whether ring i is a hole
+    ring_holes: np.ndarray
+    # Polygon i is made of rings polygon_offsets[i] up to polygon_offsets[i + 1]
+    polygon_offsets: np.ndarray
+    # The value to draw each polygon with
+    values: list[int]
+
+
 class NumpyInMemoryVolumePolygonRenderer(VolumePolygonRenderer):
 
-    def _materialize_xyz_volume(self, task: TaskInDB, checkpoints: list[Checkpoint], as_channels: bool = False):
-        """Materialize a volume in Numpy array format from a list of Checkpoints.
+    def _batch_regions(self, task: TaskInDB, checkpoints: list[Checkpoint], as_channels: bool = False) -> _RegionBatches:
+        """Group the regions of a list of Checkpoints by the slice they are drawn into.
 
         Arguments:
             - task: TaskInDB object containing task metadata.
             - checkpoints: List of Checkpoint objects to render.
-            - as_channels: If True, render each seg ID as a separate channel in the volume.
+            - as_channels: If True, batch per (slice, seg ID) and draw masks with a value of 1.
 
         """
-        x_size = task.x_max - task.x_min
-        y_size = task.y_max - task.y_min
         z_size = task.z_max - task.z_min
 
-        ids = sorted(set(poly.segmentID for checkpoint in checkpoints for poly in checkpoint.polygons))
-        id_count = len(ids)
-        logger.info(f"Total unique segment IDs found: {id_count}")
-
-        volume = np.zeros((x_size, y_size, z_size, id_count) if as_channels else (x_size, y_size, z_size), dtype=np.uint64)
-
-        logger.info(f"Creating volume of size {x_size}x{y_size}x{z_size}")
-
         # Calculate the resolution scaling factor
         resolution_factor = 2 ** task.resolution
         logger.info(f"Using resolution scaling factor: {resolution_factor} (resolution level: {task.resolution})")
 
+        # In a single pass over the polygons, collect the unique seg IDs and group the
+        # polygons by the slice (and, for channels, the seg ID) they are drawn into, so
+        # that each slice is rasterized with a single kernel call. A polygon's outer
+        # boundaries and holes are kept together as the rings of one fill, so
+        # every pixel is written at most once per polygon.
+        seen_ids: set[int] = set()
+        slices: dict[tuple[int, int | None], tuple[list[list[tuple[float, float]]], list[bool], list[int], list[int]]] = {}
         for checkpoint in checkpoints:
             for poly in checkpoint.polygons:
-                z = poly.z - task.z_min
+                seg_id = poly.segmentID
+                poly_z = poly.z
+                positive_regions = poly.positiveRegions
+                negative_regions = poly.negativeRegions
+                seen_ids.add(seg_id)
+
+                z = poly_z - task.z_min
                 if z < 0 or z >= z_size:
-                    logger.warning(f"Polygon z={poly.z} is outside volume bounds (z_min={task.z_min}, z_max={task.z_max})")
+                    logger.warning(f"Polygon z={poly_z} is outside volume bounds (z_min={task.z_min}, z_max={task.z_max})")
+                    continue
+
+                # Use the new positiveRegions/negativeRegions schema. Regions were
+                # validated as lists of (x, y) pairs when the checkpoint was parsed,
+                # so they are kept as-is here and packed into one array below.
+                rings = [region for region in positive_regions if len(region) >= 3]
+                # Holes alone would not draw anything
+                if not rings:
                     continue
+                n_positive = len(rings)
+                rings.extend(region for region in negative_regions if len(region) >= 3)
+
+                slice_rings, slice_holes, ring_counts, values = slices.setdefault((z, seg_id if as_channels else None), ([], [], [], []))
+                slice_rings.extend(rings)
+                slice_holes.extend(i >= n_positive for i in range(len(rings)))
+                ring_counts.append(len(rings))
+                values.append(1 if as_channels else seg_id)
+
+        ids = sorted(seen_ids)
+        logger.info(f"Total unique segment IDs found: {len(ids)}")
+
+        if not slices:
+            empty_offsets = np.zeros(1, dtype=np.int64)
+            return _RegionBatches(ids, {}, np.empty((0, 2)), empty_offsets, np.zeros(0, dtype=np.bool_), empty_offsets, [])
+
+        # Pack the vertices of every ring into one array in a single conversion,
+        # ordered by slice so that each slice is a contiguous block, then scale down
+        # by resolution factor and offset them to be relative to task bounds in a
+        # single vectorized pass.
+        all_rings = [ring for rings, _, _, _ in slices.values() for ring in rings]
+        ring_lengths = [len(ring) for ring in all_rings]
+        n_points = sum(ring_lengths)
+        all_points = np.fromiter(
+            chain.from_iterable(chain.from_iterable(all_rings)), dtype=np.float64, count=2 * n_points
+        ).reshape(n_points, 2)
+        all_points *= 1.0 / resolution_factor
+        all_points -= np.array([task.x_min, task.y_min], dtype=all_points.dtype)
+        ring_offsets = np.cumsum([0] + ring_lengths)
+        ring_holes = np.array([hole for _, holes, _, _ in slices.values() for hole in holes], dtype=np.bool_)
+        polygon_offsets = np.cumsum([0] + [count for _, _, ring_counts, _ in slices.values() for count in ring_counts])
+        all_values = [value for _, _, _, values in slices.values() for value in values]
+
+        batches = {}
+        start = 0
+        for key, (_, _, _, values) in slices.items():
+            batches[key] = (start, start + len(values))
+            start += len(values)
+
+        logger.info(f"Batched {len(all_values)} polygons ({len(all_points)} vertices) into {len(batches)} slices")
+
+        return _RegionBatches(ids, batches, all_points, ring_offsets, ring_holes, polygon_offsets, all_values)
+
+    def _materialize_zyx_volume(self, task: TaskInDB, checkpoints: list[Checkpoint], as_channels: bool = False):
+        """Materialize a (z, y, x) volume in Numpy array format from a list of Checkpoints.
+
+        Arguments:
+            - task: TaskInDB object containing task metadata.
+            - checkpoints: List of Checkpoint objects to render.
+            - as_channels: If True, render each seg ID as a separate (c, z, y, x) channel in
+              the volume, in sorted seg ID order. Each channel is a uint8 mask holding 1
+              inside that segment and 0 elsewhere.
+
+        The single-channel volume uses the smallest unsigned dtype that fits every seg ID.
+        Volumes are C-ordered, so every z slice (and every channel) is contiguous.
+
+        """
+        x_size = task.x_max - task.x_min
+        y_size = task.y_max - task.y_min
+        z_size = task.z_max - task.z_min
+
+        region_batches = self._batch_regions(task, checkpoints, as_channels=as_channels)
+        ids = region_batches.ids
+        id_to_channel = {seg_id: channel for channel, seg_id in enumerate(ids)}
+
+        if as_channels:
+            # Each channel only ever holds 0 or its own seg ID, so store it as a mask
+            volume = np.zeros((len(ids), z_size, y_size, x_size), dtype=np.uint8)
+        else:
+            volume = np.zeros((z_size, y_size, x_size), dtype=_label_dtype(ids[-1] if ids else 0))
+
+        logger.info(f"Creating volume of size {x_size}x{y_size}x{z_size}")
+
+        values = np.array(region_batches.values, dtype=volume.dtype)
+        for (z, seg_id), (start, stop) in region_batches.batches.items():
+            target = volume[id_to_channel[seg_id]] if as_channels else volume
+            written = fill_polygons_scanline(
+                target, region_batches.points, region_batches.ring_offsets, region_batches.ring_holes, region_batches.polygon_offsets[start : stop + 1], values[start:stop], z, x_size, y_size
+            )
 
-                # Use the new positiveRegions/negativeRegions schema
-                logger.info(f"Rendering polygon: {len(poly.positiveRegions)} positive regions, {len(poly.negativeRegions)} negative regions")
-
-                # Rasterize all positive regions (outer boundaries)
-                for positive_region in poly.positiveRegions:
-                    points = np.array(positive_region)
-                    if points.ndim != 2 or len(points) < 3:
-                        continue
-
-                    # Scale down coordinates by resolution factor and offset points to be relative to task bounds
-                    points_scaled = points / resolution_factor
-                    points_offset = points_scaled.copy()
-                    points_offset[:, 0] -= task.x_min
-                    points_offset[:, 1] -= task.y_min
-
-                    logger.info(f"Positive region: Original coords range x:[{points[:, 0].min():.1f}, {points[:, 0].max():.1f}], y:[{points[:, 1].min():.1f}, {points[:, 1].max():.1f}]")
-                    logger.info(f"Positive region: Scaled coords range x:[{points_offset[:, 0].min():.1f}, {points_offset[:, 0].max():.1f}], y:[{points_offset[:, 1].min():.1f}, {points_offset[:, 1].max():.1f}]")
-
-                    rr, cc = polygon(points_offset[:, 1], points_offset[:, 0])  # Note: y, x order for polygon
-                    rr = np.clip(rr, 0, y_size - 1)
-                    cc = np.clip(cc, 0, x_size - 1)
-
-                    logger.info(f"Positive region: {len(rr)} pixels set to segmentID {poly.segmentID}")
-                    if as_channels:
-                        volume[cc, rr, z, ids.index(poly.segmentID)] = poly.segmentID
-                    else:
-                        volume[cc, rr, z] = poly.segmentID
-
-                # Subtract all negative regions (holes)
-                for negative_region in poly.negativeRegions:
-                    hole_points = np.array(negative_region)
-                    if hole_points.ndim != 2 or len(hole_points) < 3:
-                        continue
-
-                    # Scale down coordinates by resolution factor and offset hole points to be relative to task bounds
-                    hole_points_scaled = hole_points / resolution_factor
-                    hole_points_offset = hole_points_scaled.copy()
-                    hole_points_offset[:, 0] -= task.x_min
-                    hole_points_offset[:, 1] -= task.y_min
-
-                    hole_rr, hole_cc = polygon(hole_points_offset[:, 1], hole_points_offset[:, 0])  # Note: y, x order
-                    hole_rr = np.clip(hole_rr, 0, y_size - 1)
-                    hole_cc = np.clip(hole_cc, 0, x_size - 1)
-
-                    logger.info(f"Negative region: {len(hole_rr)} pixels cleared")
-                    if as_channels:
-                        volume[hole_cc, hole_rr, z, ids.index(poly.segmentID)] = 0
-                    else:
-                        volume[hole_cc, hole_rr, z] = 0
+            logger.info(f"Slice z={z}: {stop - start} polygons rasterized, {written} pixels written")
 
         return volume
 
+    def _materialize_zyx_masks(self, task: TaskInDB, checkpoints: list[Checkpoint]) -> Iterator[tuple[int, np.ndarray]]:
+        """Materialize a separate mask volume for each seg ID, one at a time.
+
+        Each mask is a C-contiguous (z, y, x) uint8 array holding 1 inside the segment
+        and 0 elsewhere. Only one mask is alive at a time, so peak memory is a single
+        volume rather than one per seg ID as with `as_channels=True`.
+
+        Arguments:
+            - task: TaskInDB object containing task metadata.
+            - checkpoints: List of Checkpoint objects to render.
+
+        Yields (seg ID, mask) pairs in increasing seg ID order.
+
+        """
+        x_size = task.x_max - task.x_min
+        y_size = task.y_max - task.y_min
+        z_size = task.z_max - task.z_min
+
+        region_batches = self._batch_regions(task, checkpoints, as_channels=True)
+        values = np.array(region_batches.values, dtype=np.uint8)
+
+        batches_by_id: dict[int, list[tuple[int, int, int]]] = {}
+        for (z, seg_id), (start, stop) in region_batches.batches.items():
+            batches_by_id.setdefault(seg_id, []).append((z, start, stop))
+
+        for seg_id in region_batches.ids:
+            mask = np.zeros((z_size, y_size, x_size), dtype=np.uint8)
+            for z, start, stop in batches_by_id.get(seg_id, ()):
+                fill_polygons_scanline(
+                    mask, region_batches.points, region_batches.ring_offsets, region_batches.ring_holes, region_batches.polygon_offsets[start : stop + 1], values[start:stop], z, x_size, y_size
+                )
+            yield seg_id, mask
+
+    def _materialize_yx_slices(self, task: TaskInDB, checkpoints: list[Checkpoint]) -> Iterator[tuple[int, np.ndarray]]:
+        """Materialize only the slices that have polygons on them, one at a time.
+
+        Unlike `_materialize_zyx_volume`, the full (z, y, x) volume is never allocated:
+        peak memory is a single (y, x) slice, which matters for sparse annotations.
+
+        Arguments:
+            - task: TaskInDB object containing task metadata.
+            - checkpoints: List of Checkpoint objects to render.
+
+        Yields (z, slice) pairs in increasing z order.
+
+        """
+        x_size = task.x_max - task.x_min
+        y_size = task.y_max - task.y_min
+
+        region_batches = self._batch_regions(task, checkpoints)
+        ids = region_batches.ids
+        dtype = _label_dtype(ids[-1] if ids else 0)
+        values = np.array(region_batches.values, dtype=dtype)
+
+        for (z, _), (start, stop) in sorted(region_batches.batches.items()):
+            slab = np.zeros((1, y_size, x_size), dtype=dtype)
+            written = fill_polygons_scanline(
+                slab, region_batches.points, region_batches.ring_offsets, region_batches.ring_holes, region_batches.polygon_offsets[start : stop + 1], values[start:stop], 0, x_size, y_size
+            )
+
+            logger.info(f"Slice z={z}: {stop - start} polygons rasterized, {written} pixels written")
+            yield z, slab[0]
+
 
 class ImageStackVolumePolygonRenderer(NumpyInMemoryVolumePolygonRenderer):
 
-    def __init__(self, directory: str = "./", fmt: str = "tif"):
+    def __init__(self, directory: str = "./", fmt: str = "tif", max_workers: int | None = None):
         self.fmt = fmt
         self.directory = directory
+        self.max_workers = max_workers or os.cpu_count() or 1
         pathlib.Path(self.directory).mkdir(parents=True, exist_ok=True)
 
+    def _write_slice(self, task: TaskInDB, z: int, slab: np.ndarray):
+        # Label images are mostly runs of the same value, so even the fastest
+        # deflate level with a horizontal predictor shrinks them dramatically.
+        tifffile.imwrite(
+            f"{self.directory}{task.collection}_{task.experiment}_{task.channel}_{task.resolution}_{task.id}.{z}.{self.fmt}",
+            slab.astype(np.uint16, copy=False),
+            compression="zlib",
+            compressionargs={"level": 1},
+            predictor=True,
+            tile=(256, 256),
+        )
+
     def render_from_checkpoints(self, task: TaskInDB, checkpoints: list[Checkpoint]):
         """Render a volume in Numpy array format from a list of Checkpoints"""
-        volume = self._materialize_xyz_volume(task, checkpoints)
-
-        # fpath = f"{self.directory}{task.collection}_{task.experiment}_{task.channel}_{task.resolution}_{task.id}.{z}.{self.fmt}"
-        for z in range(volume.shape[-1]):
-            if np.sum(volume[:, :, z]) == 0:
-                logger.info(f"Skipping empty slice at z={z}")
-                continue
-            imsave(
-                f"{self.directory}{task.collection}_{task.experiment}_{task.channel}_{task.resolution}_{task.id}.{z}.{self.fmt}",
-                volume[:, :, z].astype(np.uint16)
-            )
+        # Empty slices are never rasterized, so there is nothing to skip here.
+        # Compression releases the GIL, so slices are encoded and written on a
+        # thread pool while the next ones are rasterized. At most two slices per
+        # worker are in flight, to keep peak memory bounded.
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = set()
+            for z, slab in self._materialize_yx_slices(task, checkpoints):
+                if len(pending) >= 2 * self.max_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(executor.submit(self._write_slice, task, z, slab))
+            for future in pending:
+                future.result()
 
 
 class BossDBInternVolumePolygonRenderer(NumpyInMemoryVolumePolygonRenderer):
@@ -136,8 +288,10 @@ class BossDBInternVolumePolygonRenderer(NumpyInMemoryVolumePolygonRenderer):
             f"bossdb://{task.destination_collection}/{task.destination_experiment}/{task.destination_channel}",
             resolution=task.resolution,
         )
-        print(f"bossdb://{task.destination_collection}/{task.destination_experiment}/{task.destination_channel}")
-        volume = self._materialize_xyz_volume(task, checkpoints).transpose(2, 1, 0)
+        logger.info(f"Uploading to bossdb://{task.destination_collection}/{task.destination_experiment}/{task.destination_channel}")
+        # The destination channel is uint64, whatever dtype the volume was rendered in.
+        # The volume is already laid out (z, y, x) like the cutout, so no transpose.
+        volume = self._materialize_zyx_volume(task, checkpoints).astype(np.uint64, copy=False)
         dataset[
             task.z_min : task.z_max,
             task.y_min : task.y_max,
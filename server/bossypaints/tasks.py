@@ -1,6 +1,9 @@
 import abc
-import json
+import heapq
+import itertools
+import os
 import uuid
+import orjson
 import pydantic
 from typing import List
 
@@ -29,6 +32,10 @@ class TaskInDB(Task):
     id: TaskID
 
 
+# Validates and serializes a whole task file at once, in pydantic-core
+_tasks_adapter = pydantic.TypeAdapter(dict[TaskID, TaskInDB])
+
+
 class TaskQueueStore(abc.ABC):
     """
     A base class for task queue stores.
@@ -48,12 +55,31 @@ class TaskQueueStore(abc.ABC):
     def delete(self, task_id: TaskID) -> None:
         pass
 
+    @abc.abstractmethod
+    def update(self, task_id: TaskID, task: TaskInDB) -> None:
+        """Replace an existing task with a modified copy of it."""
+        pass
+
+    def assign(self, task_id: TaskID, assigned_to: str | None) -> TaskInDB:
+        task = self.get(task_id).model_copy(update={"assigned_to": assigned_to})
+        self.update(task_id, task)
+        return task
+
     @abc.abstractmethod
     def list(self) -> List[TaskInDB]:
         pass
 
     @abc.abstractmethod
-    def list_for_user(self, username: str) -> List[TaskInDB]:
+    def list_for_user(self, username: str | None) -> List[TaskInDB]:
+        pass
+
+    def next_for_user(self, username: str) -> TaskInDB | None:
+        """Return the user's highest-priority task (the earliest added on ties), or None."""
+        return max(self.list_for_user(username), key=lambda task: task.priority, default=None)
+
+    @abc.abstractmethod
+    def get_version(self) -> str:
+        """Return an opaque version string that changes whenever any task is added, changed or deleted."""
         pass
 
 
@@ -61,10 +87,14 @@ class InMemoryTaskQueueStore(TaskQueueStore):
     def __init__(self):
         self._tasks = {}
         self._next_id = 0
+        # Versions restart with each store, so they are scoped to a random epoch
+        self._epoch = uuid.uuid4().hex
+        self._version = 0
 
     def put(self, task: Task) -> TaskID:
         task_id = uuid.uuid4().hex
-        self._tasks[task_id] = TaskInDB(id=task_id, **task.dict())
+        self._tasks[task_id] = TaskInDB(id=task_id, **task.model_dump())
+        self._version += 1
         return task_id
 
     def get(self, task_id: TaskID) -> TaskInDB:
@@ -72,60 +102,176 @@ class InMemoryTaskQueueStore(TaskQueueStore):
 
     def delete(self, task_id: TaskID) -> None:
         del self._tasks[task_id]
+        self._version += 1
+
+    def update(self, task_id: TaskID, task: TaskInDB) -> None:
+        if task_id not in self._tasks:
+            raise KeyError(task_id)
+        self._tasks[task_id] = task
+        self._version += 1
 
     def list(self) -> List[TaskInDB]:
         return list(self._tasks.values())
 
-    def list_for_user(self, username: str) -> List[TaskInDB]:
+    def list_for_user(self, username: str | None) -> List[TaskInDB]:
         return [task for task in self._tasks.values()
                 if task.assigned_to == username]
 
+    def get_version(self) -> str:
+        return f"{self._epoch}-{self._version}"
+
 
 class JSONFileTaskQueueStore(TaskQueueStore):
+    """
+    A task store that keeps every task in memory, backed by a JSON file.
+
+    The file is read once, when the store is created. Mutations are appended
+    to a JSONL log next to it (`<filename>.log`) instead of rewriting the whole
+    file, and the log is folded back into the file (compacted) at startup and
+    every `compact_every` mutations.
+
+    Tasks are also indexed by assignee, so a user's tasks are found without
+    scanning every task, and each user's tasks are kept in a max-heap on
+    priority, so their next task is found without sorting on every request.
+
+    Mutations run synchronously without yielding to the event loop, so they
+    never interleave with each other.
+    """
+
+    compact_every = 1000
+
     def __init__(self, filename: str):
         self._filename = filename
+        self._log_filename = f"{filename}.log"
+        # Versions restart with each store, so they are scoped to a random epoch
+        self._epoch = uuid.uuid4().hex
+        self._version = 0
+        self._tasks = self._load_latest_from_file()
+        self._replay_log()
+        self.compact()
 
     def new_uid(self) -> TaskID:
         return str(uuid.uuid4())
 
     def _load_latest_from_file(self) -> dict[TaskID, TaskInDB]:
         try:
-            with open(self._filename) as f:
-                json_data = json.load(f)
-
-            return {
-                task_id: TaskInDB(**task_data)
-                for task_id, task_data in json_data.items()
-            }
+            with open(self._filename, "rb") as f:
+                return _tasks_adapter.validate_json(f.read())
 
         except FileNotFoundError:
             return {}
 
     def _write_to_file(self, tasks: dict[TaskID, TaskInDB]) -> None:
-        with open(self._filename, "w") as f:
-            json.dump({task_id: task.dict() for task_id, task in tasks.items()}, f)
+        # Write to a temporary file and swap it in, so readers never see a partial file
+        tmp_filename = f"{self._filename}.tmp"
+        with open(tmp_filename, "wb") as f:
+            f.write(_tasks_adapter.dump_json(tasks))
+        os.replace(tmp_filename, self._filename)
+
+    def _replay_log(self) -> None:
+        try:
+            with open(self._log_filename, "rb") as f:
+                for line in f:
+                    try:
+                        record = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        # A record cut short by a crash mid-append; nothing follows it
+                        break
+                    if record["op"] == "put":
+                        self._tasks[record["id"]] = TaskInDB.model_validate(record["task"])
+                    elif record["op"] == "delete":
+                        self._tasks.pop(record["id"], None)
+        except FileNotFoundError:
+            pass
+        self._pending = 0
+
+    def _append_to_log(self, record: dict) -> None:
+        # Every mutation is logged, so this is where the version is bumped
+        self._version += 1
+        with open(self._log_filename, "ab") as f:
+            f.write(orjson.dumps(record) + b"\n")
+        self._pending += 1
+        if self._pending >= self.compact_every:
+            self.compact()
+
+    def compact(self) -> None:
+        """Rewrite the task file from memory and truncate the mutation log."""
+        self._write_to_file(self._tasks)
+        open(self._log_filename, "w").close()
+        self._pending = 0
+        self._rebuild_indexes()
+
+    def _rebuild_indexes(self) -> None:
+        # Tasks are listed, and ties on priority broken, in the order they were
+        # first added, so each task keeps the sequence number it was first seen with
+        self._seq = {task_id: seq for seq, task_id in enumerate(self._tasks)}
+        self._next_seq = itertools.count(len(self._seq))
+        self._by_user: dict[str | None, set[TaskID]] = {}
+        self._heaps: dict[str | None, list[tuple[int, int, TaskID]]] = {}
+        for task in self._tasks.values():
+            self._by_user.setdefault(task.assigned_to, set()).add(task.id)
+            self._heaps.setdefault(task.assigned_to, []).append((-task.priority, self._seq[task.id], task.id))
+        for heap in self._heaps.values():
+            heapq.heapify(heap)
+
+    def _push(self, task: TaskInDB) -> None:
+        # Entries are never removed eagerly; ones for deleted or reassigned
+        # tasks are skipped (and dropped) when they reach the top of a heap
+        if task.id not in self._seq:
+            self._seq[task.id] = next(self._next_seq)
+        heapq.heappush(self._heaps.setdefault(task.assigned_to, []), (-task.priority, self._seq[task.id], task.id))
+
+    def _save(self, task: TaskInDB) -> None:
+        previous = self._tasks.get(task.id)
+        if previous is not None:
+            self._by_user[previous.assigned_to].discard(task.id)
+        self._by_user.setdefault(task.assigned_to, set()).add(task.id)
+        self._tasks[task.id] = task
+        self._push(task)
+        self._append_to_log({"op": "put", "id": task.id, "task": task.model_dump()})
 
     def put(self, task: Task) -> TaskID:
-        tasks = self._load_latest_from_file()
         task_id = self.new_uid()
-        tasks[task_id] = TaskInDB(id=task_id, **task.dict())
-        self._write_to_file(tasks)
+        self._save(TaskInDB(id=task_id, **task.model_dump()))
         return task_id
 
     def get(self, task_id: TaskID) -> TaskInDB:
-        tasks = self._load_latest_from_file()
-        return tasks[task_id]
+        return self._tasks[task_id]
 
     def delete(self, task_id: TaskID) -> None:
-        tasks = self._load_latest_from_file()
-        del tasks[task_id]
-        self._write_to_file(tasks)
+        task = self._tasks.pop(task_id)
+        self._by_user[task.assigned_to].discard(task_id)
+        self._seq.pop(task_id, None)
+        self._append_to_log({"op": "delete", "id": task_id})
+
+    def update(self, task_id: TaskID, task: TaskInDB) -> None:
+        if task_id not in self._tasks:
+            raise KeyError(task_id)
+        if task.id != task_id:
+            raise ValueError(f"Task ID {task.id} does not match {task_id}")
+        self._save(task)
 
     def list(self) -> List[TaskInDB]:
-        tasks = self._load_latest_from_file()
-        return list(tasks.values())
+        return list(self._tasks.values())
 
-    def list_for_user(self, username: str) -> List[TaskInDB]:
-        tasks = self._load_latest_from_file()
-        return [task for task in tasks.values()
-                if task.assigned_to == username]
+    def list_for_user(self, username: str | None) -> List[TaskInDB]:
+        task_ids = sorted(self._by_user.get(username, ()), key=self._seq.__getitem__)
+        return [self._tasks[task_id] for task_id in task_ids]
+
+    def next_for_user(self, username: str) -> TaskInDB | None:
+        heap = self._heaps.get(username)
+        while heap:
+            neg_priority, seq, task_id = heap[0]
+            task = self._tasks.get(task_id)
+            if (
+                task is not None
+                and task.assigned_to == username
+                and task.priority == -neg_priority
+                and self._seq.get(task_id) == seq
+            ):
+                return task
+            heapq.heappop(heap)
+        return None
+
+    def get_version(self) -> str:
+        return f"{self._epoch}-{self._version}"
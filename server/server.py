@@ -1,130 +1,322 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+from contextlib import asynccontextmanager
 from typing import Optional
 
-import fastapi
 import httpx
-from fastapi import FastAPI, Request, Response, APIRouter, BackgroundTasks, HTTPException
+from fastapi import FastAPI, Request, Response, APIRouter, Depends, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, TypeAdapter
 from dotenv import load_dotenv
+import msgspec
+import orjson
 
-from bossypaints.background import render_and_mesh
-from bossypaints.tasks import JSONFileTaskQueueStore, Task, TaskID
-from bossypaints.checkpoints import Checkpoint, JSONCheckpointStore
+from bossypaints.background import RenderQueue
+from bossypaints.tasks import JSONFileTaskQueueStore, Task, TaskID, TaskInDB
+from bossypaints.checkpoints import MsgpackCheckpointStore, checkpoint_from_request_body
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = fastapi.FastAPI()
+# All BossDB requests go through app.state.http, with paths relative to this URL
+BOSSDB_API_URL = "https://api.bossdb.io/v1"
+
+# How long shutdown waits for queued renders before dropping the rest
+RENDER_DRAIN_TIMEOUT = 60
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One client for the whole app, so connections (and TLS sessions) to BossDB
+    # are pooled and kept alive across requests instead of set up per request.
+    app.state.http = httpx.AsyncClient(
+        base_url=BOSSDB_API_URL,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+        http2=True,
+        # Fail fast if BossDB is unreachable, but leave time for slow responses
+        timeout=httpx.Timeout(10.0, connect=3.0),
+    )
+    app.state.render_queue = RenderQueue()
+    app.state.render_queue.start()
+    yield
+    # Let queued renders finish before anything they depend on is torn down
+    await app.state.render_queue.close(timeout=RENDER_DRAIN_TIMEOUT)
+    await app.state.http.aclose()
+    # Fold the mutation log into the task file, so the next start has nothing to replay
+    task_store.compact()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
-    allow_credentials=True,
+    # Requests authenticate with an Authorization header, not cookies. Without
+    # credentials, every response gets a static "Access-Control-Allow-Origin: *"
+    # instead of a copy of the request's origin.
+    allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
 task_store = JSONFileTaskQueueStore("tasks.json")
 
-checkpoint_store = JSONCheckpointStore("checkpoints.json")
+checkpoint_store = MsgpackCheckpointStore("checkpoints.msgpack", legacy_json_filename="checkpoints.json")
 
 api_router = APIRouter()
 
 
-async def get_username_from_request(request: Request) -> str:
-    """Extract username from BossDB token in request headers."""
-    token = request.headers.get("Authorization", "").split(" ")[1] if request.headers.get("Authorization") else None
-    if not token:
+def _json(response: httpx.Response):
+    """Parse a JSON response body with orjson, which is much faster than httpx's .json()."""
+    return orjson.loads(response.content)
+
+
+def _check_bossdb_response(response: httpx.Response) -> None:
+    """Pass a BossDB error on to the client, instead of failing with a 500.
+
+    4xx statuses are forwarded as they are; BossDB's own failures become a 502.
+
+    """
+    if response.status_code >= 400:
+        raise HTTPException(
+            status_code=response.status_code if response.status_code < 500 else 502,
+            detail=f"BossDB request failed: {response.text}",
+        )
+
+
+def _token_digest(token: str) -> str:
+    """Hash a token for use as a cache key, so raw tokens are not kept around."""
+    return hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+
+
+# Almost every endpoint authenticates, and a session presents the same token
+# over and over, so the username BossDB resolves a token to is cached briefly.
+_USER_CACHE_TTL = 300
+_USER_CACHE_MAX_ENTRIES = 10_000
+_user_cache: dict[str, tuple[float, str]] = {}
+
+
+async def get_bossdb_token(authorization: Optional[str] = Header(None)) -> str:
+    """Extract the BossDB token from a `Token <token>` (or `Bearer <token>`) Authorization header."""
+    scheme, _, token = (authorization or "").partition(" ")
+    token = token.strip()
+    if scheme.lower() not in ("token", "bearer") or not token:
         raise HTTPException(status_code=401, detail="Authorization token required")
+    return token
+
+
+async def get_username(request: Request, token: str = Depends(get_bossdb_token)) -> str:
+    """Extract username from BossDB token in request headers."""
+    token_digest = _token_digest(token)
+    cached = _user_cache.get(token_digest)
+    if cached and time.monotonic() - cached[0] < _USER_CACHE_TTL:
+        return cached[1]
 
-    async with httpx.AsyncClient() as client:
+    client = request.app.state.http
+    try:
+        response = await client.get(
+            "/groups/",
+            headers={
+                "Authorization": f"Token {token}",
+                "Accept": "application/json",
+            },
+        )
+        response.raise_for_status()
+        data = _json(response)
+        primary_group = next((grp for grp in data["groups"] if grp.endswith("-primary")), None)
+        if primary_group is None:
+            raise ValueError("No primary group found for this token")
+        username = primary_group.removesuffix("-primary")
+    except Exception as e:
+        raise HTTPException(status_code=401, detail=f"Invalid authorization token: {str(e)}")
+
+    _cache_insert(_user_cache, token_digest, username, _USER_CACHE_TTL, _USER_CACHE_MAX_ENTRIES)
+    return username
+
+
+# Experiment and coordinate frame metadata practically never changes, so BossDB
+# GETs for it are cached for a few minutes. Entries are keyed by a digest of the
+# caller's token as well as the URL, so nobody is served a response fetched with
+# someone else's permissions.
+_BOSSDB_CACHE_TTL = 300
+_BOSSDB_CACHE_MAX_ENTRIES = 1024
+_bossdb_cache: dict[tuple[str, str], tuple[float, dict]] = {}
+_bossdb_cache_locks: dict[tuple[str, str], asyncio.Lock] = {}
+
+
+async def get_bossdb_json_cached(client: httpx.AsyncClient, url: str, authorization: str) -> dict:
+    """GET a BossDB resource as JSON, answering from the cache while it is fresh."""
+    key = (_token_digest(authorization), url)
+    cached = _bossdb_cache.get(key)
+    if cached and time.monotonic() - cached[0] < _BOSSDB_CACHE_TTL:
+        return cached[1]
+
+    # Concurrent misses for the same key wait for a single fetch
+    async with _bossdb_cache_locks.setdefault(key, asyncio.Lock()):
+        cached = _bossdb_cache.get(key)
+        if cached and time.monotonic() - cached[0] < _BOSSDB_CACHE_TTL:
+            return cached[1]
         try:
             response = await client.get(
-                "https://api.bossdb.io/v1/groups/",
+                url,
                 headers={
-                    "Authorization": f"Token {token}",
+                    "Authorization": authorization,
                     "Accept": "application/json",
                 },
             )
-            response.raise_for_status()
-            data = response.json()
-            username = [grp for grp in data["groups"] if grp.endswith("-primary")][0].split(
-                "-primary"
-            )[0]
-            return username
-        except Exception as e:
-            raise HTTPException(status_code=401, detail=f"Invalid authorization token: {str(e)}")
+            _check_bossdb_response(response)
+            data = _json(response)
+        finally:
+            _bossdb_cache_locks.pop(key, None)
+
+    _cache_insert(_bossdb_cache, key, data, _BOSSDB_CACHE_TTL, _BOSSDB_CACHE_MAX_ENTRIES)
+    return data
+
+
+def _cache_insert(cache: dict, key, value, ttl: float, max_entries: int):
+    """Store `(now, value)` under `key`, making room if the cache is full."""
+    now = time.monotonic()
+    if len(cache) >= max_entries:
+        for stale_key in [k for k, (fetched_at, *_) in cache.items() if now - fetched_at >= ttl]:
+            del cache[stale_key]
+        if len(cache) >= max_entries:
+            # Still full of fresh entries; evict the oldest
+            del cache[next(iter(cache))]
+    cache[key] = (now, value)
+
+
+async def fetch_experiment(client: httpx.AsyncClient, collection: str, experiment: str, authorization: str) -> dict:
+    return await get_bossdb_json_cached(
+        client, f"/collection/{collection}/experiment/{experiment}", authorization
+    )
+
+
+async def fetch_experiment_if_accessible(
+    client: httpx.AsyncClient, collection: str, experiment: str, authorization: str
+) -> Optional[dict]:
+    """Like `fetch_experiment`, but returns None if BossDB refuses the request."""
+    try:
+        return await fetch_experiment(client, collection, experiment, authorization)
+    except HTTPException:
+        return None
+
+
+# Task lists are serialized in one pass in pydantic-core, instead of each task
+# being converted to a dict and then walked again by jsonable_encoder
+_task_list_adapter = TypeAdapter(dict[str, list[TaskInDB]])
+
+
+def _task_list_response(tasks: list[TaskInDB]) -> Response:
+    return Response(
+        content=_task_list_adapter.dump_json({"tasks": tasks}),
+        media_type="application/json",
+    )
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """Whether the request's If-None-Match header lists `etag` (or is `*`)."""
+    if_none_match = request.headers.get("If-None-Match")
+    return bool(if_none_match) and (
+        if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+    )
 
 
 @api_router.get("/tasks")
-async def get_tasks(request: Request):
-    username = await get_username_from_request(request)
-    tasks = task_store.list_for_user(username)
-    return {"tasks": tasks}
+async def get_tasks(username: str = Depends(get_username)):
+    return _task_list_response(task_store.list_for_user(username))
 
 
 @api_router.get("/tasks/next")
-async def get_next_task(request: Request):
-    username = await get_username_from_request(request)
-    tasks = task_store.list_for_user(username)
-    if tasks:
-        # Sort by priority (higher priority first) and return the first one
-        tasks.sort(key=lambda t: t.priority, reverse=True)
-        return {"task": tasks[0]}
-    else:
-        return {"task": None}
+async def get_next_task(request: Request, response: Response, username: str = Depends(get_username)):
+    # Highest priority first
+    task = task_store.next_for_user(username)
+
+    # Clients poll this; answer 304 until any task changes. The task ID is part
+    # of the tag so that a tag never matches another user's next task.
+    etag = f'W/"{task.id if task else "none"}-{task_store.get_version()}"'
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return {"task": task}
+
+
+# Registered before the /tasks/{task_id} routes, which would otherwise match it.
+# Only verifies that the requester is authenticated.
+@api_router.get("/tasks/unassigned", dependencies=[Depends(get_username)])
+async def get_unassigned_tasks():
+    """Get all tasks that are not assigned to any user."""
+    return _task_list_response(task_store.list_for_user(None))
+
 
 @api_router.post("/tasks/{task_id}/save")
-async def save_task(request: Request, task_id: TaskID, checkpoint: dict, background_tasks: BackgroundTasks):
-    username = await get_username_from_request(request)
+async def save_task(request: Request, task_id: TaskID, username: str = Depends(get_username)):
     task = task_store.get(task_id)
 
     # Verify user owns this task
     if not task or task.assigned_to != username:
         raise HTTPException(status_code=404, detail="Task not found or not assigned to you")
 
-    checkpoint_obj = Checkpoint(taskID=task_id, polygons=checkpoint["checkpoint"])
+    # Checkpoints can hold a lot of polygons, so the body is decoded straight
+    # into them instead of being parsed into dicts first
+    try:
+        checkpoint_obj = checkpoint_from_request_body(task_id, await request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
     checkpoint_store.save_checkpoint(checkpoint_obj)
 
-    # Kick off a background task to render the volume
-    background_tasks.add_task(render_and_mesh, task_id, task, checkpoint_store.get_checkpoints_for_task(task_id))
+    # Queue the volume to be rendered in the background
+    request.app.state.render_queue.submit(task_id, task, checkpoint_store.get_checkpoints_for_task(task_id))
     return {"message": "Checkpoint received and rendering started"}
 
 
 
 @api_router.post("/tasks/{task_id}/checkpoint")
-async def checkpoint_task(request: Request, task_id: TaskID, checkpoint: dict):
-    username = await get_username_from_request(request)
+async def checkpoint_task(request: Request, task_id: TaskID, username: str = Depends(get_username)):
     task = task_store.get(task_id)
 
     # Verify user owns this task
     if not task or task.assigned_to != username:
         raise HTTPException(status_code=404, detail="Task not found or not assigned to you")
 
-    checkpoint_obj = Checkpoint(taskID=task_id, polygons=checkpoint["checkpoint"])
+    # Checkpoints can hold a lot of polygons, so the body is decoded straight
+    # into them instead of being parsed into dicts first
+    try:
+        checkpoint_obj = checkpoint_from_request_body(task_id, await request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
     checkpoint_store.save_checkpoint(checkpoint_obj)
     return {"message": "Checkpoint received"}
 
 
 @api_router.get("/tasks/{task_id}/checkpoints")
-async def get_task_checkpoints(request: Request, task_id: TaskID):
-    username = await get_username_from_request(request)
+async def get_task_checkpoints(request: Request, task_id: TaskID, username: str = Depends(get_username)):
     task = task_store.get(task_id)
 
     # Verify user owns this task
     if not task or task.assigned_to != username:
         raise HTTPException(status_code=404, detail="Task not found or not assigned to you")
 
+    # Clients re-poll this often; skip encoding and sending unchanged checkpoints
+    etag = f'"{checkpoint_store.get_version_for_task(task_id)}"'
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
     checkpoints = checkpoint_store.get_checkpoints_for_task(task_id)
-    return {"checkpoints": checkpoints}
+    return Response(
+        content=msgspec.json.encode({"checkpoints": checkpoints}),
+        media_type="application/json",
+        headers={"ETag": etag},
+    )
 
 
 @api_router.get("/tasks/{task_id}")
-async def get_task_by_id(request: Request, task_id: TaskID):
-    username = await get_username_from_request(request)
+async def get_task_by_id(task_id: TaskID, username: str = Depends(get_username)):
     task = task_store.get(task_id)
 
     # Verify user owns this task
@@ -135,76 +327,85 @@ async def get_task_by_id(request: Request, task_id: TaskID):
 
 
 @api_router.get("/bossdb/username")
-async def get_bossdb_username(request: Request):
-    username = await get_username_from_request(request)
+async def get_bossdb_username(username: str = Depends(get_username)):
     return {"username": username}
 
 
+# Autocomplete asks for the same listing on every keystroke. Listings are cached
+# for a short time only, so new resources show up quickly, and are kept sorted
+# case-insensitively so each lookup is a binary search.
+_RESOURCE_LIST_TTL = 60
+_resource_list_cache: dict[tuple[str, str], tuple[float, tuple[list[str], list[str]]]] = {}
+
+
+async def get_resource_list_cached(
+    client: httpx.AsyncClient, url: str, field: str, authorization: str
+) -> tuple[list[str], list[str]]:
+    """GET a BossDB listing and return its names sorted ignoring case, with their lowercase forms."""
+    key = (_token_digest(authorization), url)
+    cached = _resource_list_cache.get(key)
+    if cached and time.monotonic() - cached[0] < _RESOURCE_LIST_TTL:
+        return cached[1]
+
+    response = await client.get(
+        url,
+        headers={
+            "Authorization": authorization,
+            "Accept": "application/json",
+        },
+    )
+    _check_bossdb_response(response)
+    names = sorted(_json(response).get(field, []), key=str.lower)
+    index = (names, [name.lower() for name in names])
+    _cache_insert(_resource_list_cache, key, index, _RESOURCE_LIST_TTL, _BOSSDB_CACHE_MAX_ENTRIES)
+    return index
+
+
+def _filter_prefix(index: tuple[list[str], list[str]], prefix: str, limit: int = 50) -> list[str]:
+    """Return up to `limit` names from a sorted listing that start with `prefix`, ignoring case."""
+    names, lowered = index
+    prefix = prefix.lower()
+    start = bisect.bisect_left(lowered, prefix)
+    stop = bisect.bisect_left(lowered, prefix + "\U0010ffff", lo=start)
+    return names[start : min(stop, start + limit)]
+
+
 @api_router.get("/bossdb/autocomplete")
-async def autocomplete_bossdb_resource(request: Request, collection: str, experiment: Optional[str] = None, channel: Optional[str] = None):
+async def autocomplete_bossdb_resource(
+    request: Request,
+    collection: str,
+    experiment: Optional[str] = None,
+    channel: Optional[str] = None,
+    token: str = Depends(get_bossdb_token),
+):
     # There are three cases:
     # 1. col str    exp null    chan null   -> return all collections with prefix
     # 2. col str    exp str     chan null   -> return all experiments with prefix inside collection
     # 3. col str    exp str     chan str    -> return all channels with prefix inside experiment
-    token = request.headers.get("Authorization", "").split(" ")[1]
-    async with httpx.AsyncClient() as client:
-        if experiment in [None, "", ] and channel in [None, "", ]:
-            response = await client.get(
-                f"https://api.bossdb.io/v1/collection/",
-                headers={
-                    "Authorization": "Token " + token,
-                    "Accept": "application/json",
-                },
-            )
-            response.raise_for_status()
-            data = response.json()
-            return {"resources": [res for res in data.get("collections", []) if res.lower().startswith(collection.lower())]}
-        elif experiment not in [None, "", ] and channel in [None, "", ]:
-            response = await client.get(
-                f"https://api.bossdb.io/v1/collection/{collection}/experiment/",
-                headers={
-                    "Authorization": "Token " + token,
-                    "Accept": "application/json",
-                },
-            )
-            response.raise_for_status()
-            data = response.json()
-            return {"resources": [res for res in data.get("experiments", []) if res.lower().startswith(experiment.lower())]}
-        elif experiment not in [None, "", ] and channel not in [None, "", ]:
-            response = await client.get(
-                f"https://api.bossdb.io/v1/collection/{collection}/experiment/{experiment}/channel/",
-                headers={
-                    "Authorization": "Token " + token,
-                    "Accept": "application/json",
-                },
-            )
-            response.raise_for_status()
-            data = response.json()
-            return {"resources": [res for res in data.get("channels", []) if res.lower().startswith(channel.lower())]}
-
-@api_router.get("/bossdb/coord_frame/{collection}/{experiment}")
-async def get_coord_frame(request: Request, collection: str, experiment: str):
-    token = request.headers.get("Authorization", "").split(" ")[1]
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            f"https://api.bossdb.io/v1/collection/{collection}/experiment/{experiment}",
-            headers={
-                "Authorization": f"Token {token}",
-                "Accept": "application/json",
-            },
+    authorization = "Token " + token
+    client = request.app.state.http
+    if not experiment and not channel:
+        index = await get_resource_list_cached(client, "/collection/", "collections", authorization)
+        return {"resources": _filter_prefix(index, collection)}
+    elif experiment and not channel:
+        index = await get_resource_list_cached(
+            client, f"/collection/{collection}/experiment/", "experiments", authorization
         )
-        response.raise_for_status()
-        data = response.json()
-        coord_frame_name = data["coord_frame"]
-        response = await client.get(
-            f"https://api.bossdb.io/v1/coord/{coord_frame_name}",
-            headers={
-                "Authorization": f"Token {token}",
-                "Accept": "application/json",
-            },
+        return {"resources": _filter_prefix(index, experiment)}
+    elif experiment and channel:
+        index = await get_resource_list_cached(
+            client, f"/collection/{collection}/experiment/{experiment}/channel/", "channels", authorization
         )
-        response.raise_for_status()
-        return response.json()
+        return {"resources": _filter_prefix(index, channel)}
+
+@api_router.get("/bossdb/coord_frame/{collection}/{experiment}")
+async def get_coord_frame(request: Request, collection: str, experiment: str, token: str = Depends(get_bossdb_token)):
+    client = request.app.state.http
+    data = await fetch_experiment(client, collection, experiment, f"Token {token}")
+    coord_frame_name = data["coord_frame"]
+    return await get_bossdb_json_cached(
+        client, f"/coord/{coord_frame_name}", f"Token {token}"
+    )
 
 
 class CreateTaskRequest(BaseModel):
@@ -226,199 +427,184 @@ class CreateTaskRequest(BaseModel):
 
 @api_router.post("/tasks/create")
 async def create_task(
-    request: Request, response: Response, new_task: CreateTaskRequest
+    request: Request,
+    response: Response,
+    new_task: CreateTaskRequest,
+    # The task is assigned to the user creating it
+    username: str = Depends(get_username),
+    token: str = Depends(get_bossdb_token),
 ):
-    # Get the username from the request to assign the task to this user
-    username = await get_username_from_request(request)
-
-    # Check if the collection exists and the user has access to it
-    async with httpx.AsyncClient() as client:
-        chan_exists_resp = await client.get(
-            f"https://api.bossdb.io/v1/collection/{new_task.collection}",
-            headers={
-                "Authorization": request.headers["Authorization"],
-                "Accept": "application/json",
-            },
-        )
-        if chan_exists_resp.status_code != 200:
-            response.status_code = 404
-            return {
-                "message": "Collection does not exist or you do not have access to it"
-            }
-
-        exp_exists_resp = await client.get(
-            f"https://api.bossdb.io/v1/collection/{new_task.collection}/experiment/{new_task.experiment}",
-            headers={
-                "Authorization": request.headers["Authorization"],
-                "Accept": "application/json",
-            },
-        )
-        if exp_exists_resp.status_code != 200:
-            response.status_code = 404
-            return {
-                "message": "Experiment does not exist or you do not have access to it"
-            }
 
-        chan_exists_resp = await client.get(
-            f"https://api.bossdb.io/v1/collection/{new_task.collection}/experiment/{new_task.experiment}/channel/{new_task.channel}",
-            headers={
-                "Authorization": request.headers["Authorization"],
-                "Accept": "application/json",
-            },
-        )
-        if chan_exists_resp.status_code != 200:
-            response.status_code = 404
-            return {"message": "Channel does not exist or you do not have access to it"}
-
-        # Create the task
-        task = Task(
-            collection=new_task.collection,
-            experiment=new_task.experiment,
-            channel=new_task.channel,
-            resolution=new_task.resolution,
-            x_min=new_task.x_min,
-            x_max=new_task.x_max,
-            y_min=new_task.y_min,
-            y_max=new_task.y_max,
-            z_min=new_task.z_min,
-            z_max=new_task.z_max,
-            priority=new_task.priority,
-            destination_collection=new_task.destination_collection,
-            destination_experiment=new_task.destination_experiment,
-            destination_channel=new_task.destination_channel,
-            assigned_to=username,  # Assign the task to the user creating it
+    auth_headers = {
+        "Authorization": f"Token {token}",
+        "Accept": "application/json",
+    }
+
+    # Check if the collection, experiment and channel exist and the user has
+    # access to them. The checks are independent, so they are made concurrently.
+    # The experiment usually comes from the cache, as the UI has just looked up
+    # its coordinate frame.
+    client = request.app.state.http
+    col_exists_resp, exp_data, chan_exists_resp = await asyncio.gather(
+        client.get(
+            f"/collection/{new_task.collection}",
+            headers=auth_headers,
+        ),
+        fetch_experiment_if_accessible(
+            client, new_task.collection, new_task.experiment, auth_headers["Authorization"]
+        ),
+        client.get(
+            f"/collection/{new_task.collection}/experiment/{new_task.experiment}/channel/{new_task.channel}",
+            headers=auth_headers,
+        ),
+    )
+    if col_exists_resp.status_code != 200:
+        response.status_code = 404
+        return {
+            "message": "Collection does not exist or you do not have access to it"
+        }
+
+    if exp_data is None:
+        response.status_code = 404
+        return {
+            "message": "Experiment does not exist or you do not have access to it"
+        }
+
+    if chan_exists_resp.status_code != 200:
+        response.status_code = 404
+        return {"message": "Channel does not exist or you do not have access to it"}
+
+    # Create the task
+    task = Task(
+        collection=new_task.collection,
+        experiment=new_task.experiment,
+        channel=new_task.channel,
+        resolution=new_task.resolution,
+        x_min=new_task.x_min,
+        x_max=new_task.x_max,
+        y_min=new_task.y_min,
+        y_max=new_task.y_max,
+        z_min=new_task.z_min,
+        z_max=new_task.z_max,
+        priority=new_task.priority,
+        destination_collection=new_task.destination_collection,
+        destination_experiment=new_task.destination_experiment,
+        destination_channel=new_task.destination_channel,
+        assigned_to=username,  # Assign the task to the user creating it
+    )
+
+    # Create or confirm access to the destination collection, experiment, and channel
+    if (
+        task.destination_collection
+        and task.destination_experiment
+        and task.destination_channel
+    ):
+        # Probe all three levels concurrently. Anything below a level that has
+        # to be created is missing too, whatever its probe returned.
+        dest_col_exists_resp, dest_exp_exists_resp, dest_chan_exists_resp = await asyncio.gather(
+            client.get(
+                f"/collection/{task.destination_collection}",
+                headers=auth_headers,
+            ),
+            client.get(
+                f"/collection/{task.destination_collection}/experiment/{task.destination_experiment}",
+                headers=auth_headers,
+            ),
+            client.get(
+                f"/collection/{task.destination_collection}/experiment/{task.destination_experiment}/channel/{task.destination_channel}",
+                headers=auth_headers,
+            ),
         )
 
-        # Create or confirm access to the destination collection, experiment, and channel
-        if (
-            task.destination_collection
-            and task.destination_experiment
-            and task.destination_channel
-        ):
-            print("Checking destination collection")
-            dest_col_exists_resp = await client.get(
-                f"https://api.bossdb.io/v1/collection/{task.destination_collection}",
-                headers={
-                    "Authorization": request.headers["Authorization"],
-                    "Accept": "application/json",
+        logger.debug("Checking destination collection")
+        col_created = False
+        if dest_col_exists_resp.status_code == 404:
+            # Create the collection
+            col_creation_resp = await client.post(
+                f"/collection/{task.destination_collection}",
+                headers=auth_headers,
+                json={
+                    "description": "Created by user with BossyPaints",
                 },
             )
-            if dest_col_exists_resp.status_code == 404:
-                # Create the collection
-                col_creation_resp = await client.post(
-                    f"https://api.bossdb.io/v1/collection/{task.destination_collection}",
-                    headers={
-                        "Authorization": request.headers["Authorization"],
-                        "Accept": "application/json",
-                    },
-                    json={
-                        "description": "Created by user with BossyPaints",
-                    },
-                )
-                # check if the collection was created successfully
-                if col_creation_resp.status_code != 201:
-                    response.status_code = col_creation_resp.status_code
-                    return {
-                        "message": "Destination collection could not be created",
-                        "error": col_creation_resp.json(),
-                    }
-
-            elif dest_col_exists_resp.status_code != 200:
-                response.status_code = dest_col_exists_resp.status_code
+            # check if the collection was created successfully
+            if col_creation_resp.status_code != 201:
+                response.status_code = col_creation_resp.status_code
                 return {
-                    "message": "Destination collection does not exist or you do not have access to it"
+                    "message": "Destination collection could not be created",
+                    "error": _json(col_creation_resp),
                 }
+            col_created = True
 
-            print("Checking destination experiment")
+        elif dest_col_exists_resp.status_code != 200:
+            response.status_code = dest_col_exists_resp.status_code
+            return {
+                "message": "Destination collection does not exist or you do not have access to it"
+            }
 
-            exp_exists_resp = await client.get(
-                f"https://api.bossdb.io/v1/collection/{task.destination_collection}/experiment/{task.destination_experiment}",
-                headers={
-                    "Authorization": request.headers["Authorization"],
-                    "Accept": "application/json",
+        logger.debug("Checking destination experiment")
+        exp_created = False
+        if col_created or dest_exp_exists_resp.status_code == 404:
+            # Create the experiment.
+            # First, need to get the coordframe from the source experiment, which
+            # was already fetched when checking that it exists
+            logger.debug("Source experiment: %s", exp_data)
+            create_exp_resp = await client.post(
+                f"/collection/{task.destination_collection}/experiment/{task.destination_experiment}",
+                headers=auth_headers,
+                json={
+                    "description": f"Created by user with BossyPaints. Imagery source is {task.collection}/{task.experiment}/{task.channel}",
+                    "coord_frame": exp_data["coord_frame"],
+                    "num_hierarchy_levels": exp_data["num_hierarchy_levels"],
+                    "hierarchy_method": exp_data["hierarchy_method"],
+                    "num_time_samples": exp_data["num_time_samples"],
                 },
             )
-            if exp_exists_resp.status_code == 404:
-                # Create the experiment.
-                # First, need to get the coordframe from the source experiment
-                exp_data = await client.get(
-                    f"https://api.bossdb.io/v1/collection/{task.collection}/experiment/{task.experiment}",
-                    headers={
-                        "Authorization": request.headers["Authorization"],
-                        "Accept": "application/json",
-                    },
-                )
-                exp_data = exp_data.json()
-                print(exp_data)
-                create_exp_resp = await client.post(
-                    f"https://api.bossdb.io/v1/collection/{task.destination_collection}/experiment/{task.destination_experiment}",
-                    headers={
-                        "Authorization": request.headers["Authorization"],
-                        "Accept": "application/json",
-                    },
-                    json={
-                        "description": f"Created by user with BossyPaints. Imagery source is {task.collection}/{task.experiment}/{task.channel}",
-                        "coord_frame": exp_data["coord_frame"],
-                        "num_hierarchy_levels": exp_data["num_hierarchy_levels"],
-                        "hierarchy_method": exp_data["hierarchy_method"],
-                        "num_time_samples": exp_data["num_time_samples"],
-                    },
-                )
-                # check if the experiment was created successfully
-                if create_exp_resp.status_code != 201:
-                    response.status_code = create_exp_resp.status_code
-                    return {
-                        "message": "Destination experiment could not be created",
-                        "error": create_exp_resp.json(),
-                    }
-            elif exp_exists_resp.status_code != 200:
-                response.status_code = exp_exists_resp.status_code
+            # check if the experiment was created successfully
+            if create_exp_resp.status_code != 201:
+                response.status_code = create_exp_resp.status_code
                 return {
-                    "message": "Destination experiment does not exist or you do not have access to it"
+                    "message": "Destination experiment could not be created",
+                    "error": _json(create_exp_resp),
                 }
+            exp_created = True
+        elif dest_exp_exists_resp.status_code != 200:
+            response.status_code = dest_exp_exists_resp.status_code
+            return {
+                "message": "Destination experiment does not exist or you do not have access to it"
+            }
 
-            print("Checking destination channel")
-
-            chan_exists_resp = await client.get(
-                f"https://api.bossdb.io/v1/collection/{task.destination_collection}/experiment/{task.destination_experiment}/channel/{task.destination_channel}",
-                headers={
-                    "Authorization": request.headers["Authorization"],
-                    "Accept": "application/json",
+        logger.debug("Checking destination channel")
+        if exp_created or dest_chan_exists_resp.status_code == 404:
+            # Create the channel
+            chan_creation_resp = await client.post(
+                f"/collection/{task.destination_collection}/experiment/{task.destination_experiment}/channel/{task.destination_channel}",
+                headers=auth_headers,
+                json={
+                    "description": f"Created by user with BossyPaints. Imagery source is {task.collection}/{task.experiment}/{task.channel}",
+                    "type": "annotation",
+                    "datatype": "uint64",
+                    "base_resolution": task.resolution,
+                    # "related": [
+                    #     f"{task.collection}/{task.experiment}/{task.channel}"
+                    # ],
                 },
             )
-            if chan_exists_resp.status_code == 404:
-                # Create the channel
-                chan_creation_resp = await client.post(
-                    f"https://api.bossdb.io/v1/collection/{task.destination_collection}/experiment/{task.destination_experiment}/channel/{task.destination_channel}",
-                    headers={
-                        "Authorization": request.headers["Authorization"],
-                        "Accept": "application/json",
-                    },
-                    json={
-                        "description": f"Created by user with BossyPaints. Imagery source is {task.collection}/{task.experiment}/{task.channel}",
-                        "type": "annotation",
-                        "datatype": "uint64",
-                        "base_resolution": task.resolution,
-                        # "related": [
-                        #     f"{task.collection}/{task.experiment}/{task.channel}"
-                        # ],
-                    },
-                )
-                # check if the channel was created successfully
-                if chan_creation_resp.status_code != 201:
-                    response.status_code = chan_creation_resp.status_code
-                    return {
-                        "message": "Destination channel could not be created",
-                        "error": chan_creation_resp.json(),
-                    }
-            elif chan_exists_resp.status_code != 200:
-                response.status_code = chan_exists_resp.status_code
+            # check if the channel was created successfully
+            if chan_creation_resp.status_code != 201:
+                response.status_code = chan_creation_resp.status_code
                 return {
-                    "message": "Destination channel does not exist or you do not have access to it"
+                    "message": "Destination channel could not be created",
+                    "error": _json(chan_creation_resp),
                 }
+        elif dest_chan_exists_resp.status_code != 200:
+            response.status_code = dest_chan_exists_resp.status_code
+            return {
+                "message": "Destination channel does not exist or you do not have access to it"
+            }
 
-        task_id = task_store.put(task)
-        return {"task": task, "task_id": task_id}
+    task_id = task_store.put(task)
+    return {"task": task, "task_id": task_id}
 
 
 
@@ -427,34 +613,19 @@ class AssignTaskRequest(BaseModel):
     assigned_to: str
 
 
-@api_router.post("/tasks/{task_id}/assign")
-async def assign_task(request: Request, task_id: TaskID, assign_request: AssignTaskRequest):
+# Only verifies that the requester is authenticated
+@api_router.post("/tasks/{task_id}/assign", dependencies=[Depends(get_username)])
+async def assign_task(task_id: TaskID, assign_request: AssignTaskRequest):
     """Assign a task to a specific user. Currently allows any authenticated user to reassign tasks."""
-    username = await get_username_from_request(request)  # Verify the requester is authenticated
 
-    task = task_store.get(task_id)
-    if not task:
+    # Look the task up only once, in assign, so the check and the update cannot
+    # see different states of the store
+    try:
+        task_store.assign(task_id, assign_request.assigned_to)
+    except KeyError:
         raise HTTPException(status_code=404, detail="Task not found")
 
-    # Update the task assignment
-    task.assigned_to = assign_request.assigned_to
-
-    # Save the updated task back to the store
-    tasks = task_store._load_latest_from_file()
-    tasks[task_id] = task
-    task_store._write_to_file(tasks)
-
     return {"message": f"Task {task_id} assigned to {assign_request.assigned_to}"}
 
 
-@api_router.get("/tasks/unassigned")
-async def get_unassigned_tasks(request: Request):
-    """Get all tasks that are not assigned to any user."""
-    username = await get_username_from_request(request)  # Verify the requester is authenticated
-
-    tasks = task_store.list()
-    unassigned_tasks = [task for task in tasks if task.assigned_to is None]
-    return {"tasks": unassigned_tasks}
-
-
 app.include_router(api_router, prefix="/api")
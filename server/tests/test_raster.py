@@ -0,0 +1,175 @@
+import numpy as np
+import pytest
+from skimage.draw import polygon
+
+from bossypaints._raster import fill_polygons_scanline
+
+
+def _fill_batch(polygons, size):
+    """Draw `polygons`, a list of (rings, holes, value), with one batched kernel call."""
+    volume = np.zeros((1, size, size), dtype=np.uint16)
+    rings = [ring for poly_rings, _, _ in polygons for ring in poly_rings]
+    points = np.concatenate(rings).astype(np.float64)
+    ring_offsets = np.cumsum([0] + [len(ring) for ring in rings])
+    ring_holes = np.array([hole for _, holes, _ in polygons for hole in holes], dtype=np.bool_)
+    polygon_offsets = np.cumsum([0] + [len(poly_rings) for poly_rings, _, _ in polygons])
+    values = np.array([value for _, _, value in polygons], dtype=np.uint16)
+    written = fill_polygons_scanline(volume, points, ring_offsets, ring_holes, polygon_offsets, values, 0, size, size)
+    assert written == sum((_mask_skimage(poly_rings, holes, size)).sum() for poly_rings, holes, _ in polygons)
+    return volume[0]
+
+
+def _fill(rings, holes, size):
+    return _fill_batch([(rings, holes, 1)], size)
+
+
+def _mask_skimage(rings, holes, size):
+    """A polygon as the frontend sees it: inside any outer ring and outside every hole."""
+    inside = np.zeros((size, size), dtype=np.bool_)
+    in_hole = np.zeros((size, size), dtype=np.bool_)
+    for ring, hole in zip(rings, holes):
+        rr, cc = polygon(ring[:, 1], ring[:, 0], shape=(size, size))
+        (in_hole if hole else inside)[rr, cc] = True
+    return inside & ~in_hole
+
+
+def _fill_skimage(rings, holes, size):
+    return _mask_skimage(rings, holes, size).astype(np.uint16)
+
+
+def _random_ring(rng, center, min_radius, max_radius, integer):
+    n = rng.integers(3, 12)
+    angles = np.sort(rng.uniform(0, 2 * np.pi, n))
+    radii = rng.uniform(min_radius, max_radius, n)
+    ring = np.c_[center[0] + radii * np.cos(angles), center[1] + radii * np.sin(angles)]
+    return np.round(ring) if integer else ring
+
+
+def _square(x0, y0, x1, y1):
+    return np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]], dtype=np.float64)
+
+
+def test_integer_square_includes_its_boundary():
+    square = _square(10, 10, 20, 20)
+    filled = _fill([square], [False], 32)
+    assert filled.sum() == 121
+    assert np.array_equal(filled, _fill_skimage([square], [False], 32))
+
+
+def test_hole_boundary_is_cleared():
+    outer = _square(10, 10, 30, 30)
+    hole = _square(15, 15, 25, 25)
+    filled = _fill([outer, hole], [False, True], 40)
+    assert filled.sum() == 21 * 21 - 11 * 11
+    assert np.array_equal(filled, _fill_skimage([outer, hole], [False, True], 40))
+
+
+def test_overlapping_outer_rings_are_a_union():
+    rings = [_square(5, 5, 20, 20), _square(10, 10, 25, 25)]
+    filled = _fill(rings, [False, False], 32)
+    # Two 16 x 16 squares sharing an 11 x 11 corner
+    assert filled.sum() == 2 * 16 * 16 - 11 * 11
+    assert filled[15, 15] == 1
+    assert np.array_equal(filled, _fill_skimage(rings, [False, False], 32))
+
+
+def test_disjoint_outer_rings():
+    rings = [_square(2, 2, 8, 8), _square(20, 4, 28, 12), _square(4, 20, 9.5, 27.5)]
+    filled = _fill(rings, [False] * 3, 32)
+    assert np.array_equal(filled, _fill_skimage(rings, [False] * 3, 32))
+
+
+def test_nested_outer_rings_do_not_cancel():
+    rings = [_square(5, 5, 25, 25), _square(10, 10, 20, 20)]
+    filled = _fill(rings, [False, False], 32)
+    assert filled.sum() == 21 * 21
+
+
+def test_overlapping_holes_are_a_union():
+    rings = [_square(2, 2, 30, 30), _square(8, 8, 18, 18), _square(12, 12, 24, 24)]
+    holes = [False, True, True]
+    filled = _fill(rings, holes, 32)
+    assert filled[15, 15] == 0
+    assert np.array_equal(filled, _fill_skimage(rings, holes, 32))
+
+
+@pytest.mark.parametrize(
+    "hole",
+    [
+        _square(10, 2, 20, 12),  # shares the outer ring's top edge
+        _square(10, -5, 20, 12),  # crosses the outer ring's top edge
+        _square(-5, -5, 40, 40),  # covers the whole outer ring
+        np.array([[2, 2], [30, 30], [2, 30]], dtype=np.float64),  # shares a corner and a diagonal
+    ],
+)
+def test_hole_touching_or_crossing_the_outer_ring(hole):
+    rings = [_square(2, 2, 30, 30), hole]
+    filled = _fill(rings, [False, True], 32)
+    assert np.array_equal(filled, _fill_skimage(rings, [False, True], 32))
+
+
+def test_vertices_outside_the_volume_are_dropped():
+    # The baseline clipped out-of-bounds pixels onto the volume's edge; they
+    # are dropped instead, so the edge rows and columns get only the pixels
+    # that are really inside the polygon there
+    rings = [np.array([[5, -10], [25, -10], [15, 5]], dtype=np.float64)]
+    filled = _fill(rings, [False], 32)
+    assert np.array_equal(filled, _fill_skimage(rings, [False], 32))
+    # Row 0 crosses the triangle's sides at x = 11.7 and 18.3
+    assert np.flatnonzero(filled[0]).tolist() == list(range(12, 19))
+
+
+def test_polygon_entirely_outside_the_volume():
+    rings = [_square(40, 40, 50, 50)]
+    assert _fill(rings, [False], 32).sum() == 0
+
+
+@pytest.mark.parametrize(
+    "ring",
+    [
+        np.array([[5, 5], [20, 20], [20, 20]], dtype=np.float64),  # zero area, with a repeated vertex
+        np.array([[5, 10], [25, 10], [15, 10]], dtype=np.float64),  # collinear, horizontal
+        np.array([[10, 5], [10, 25], [10, 15]], dtype=np.float64),  # collinear, vertical
+        np.array([[5, 5], [15, 5], [25, 5], [25, 20], [5, 20]], dtype=np.float64),  # collinear vertex on an edge
+        np.array([[5, 5], [25, 5], [15, 5], [15, 20], [5, 20]], dtype=np.float64),  # edge that doubles back
+        np.array([[5, 5], [25, 25], [25, 5], [5, 25]], dtype=np.float64),  # bowtie
+    ],
+)
+def test_degenerate_rings_match_skimage(ring):
+    assert np.array_equal(_fill([ring], [False], 32), _fill_skimage([ring], [False], 32))
+
+
+@pytest.mark.parametrize("integer", [True, False])
+def test_matches_skimage(integer):
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        ring = _random_ring(rng, (30, 30), 5, 29, integer)
+        assert np.array_equal(_fill([ring], [False], 60), _fill_skimage([ring], [False], 60))
+
+
+@pytest.mark.parametrize("integer", [True, False])
+def test_multiple_rings_match_skimage(integer):
+    # Rings overlap each other, cross the volume's edges, and (when rounded)
+    # have collinear and repeated vertices
+    rng = np.random.default_rng(1)
+    for _ in range(300):
+        n_outer = rng.integers(1, 5)
+        n_holes = rng.integers(0, 3)
+        rings = [_random_ring(rng, rng.uniform(5, 35, 2), 3, 15, integer) for _ in range(n_outer + n_holes)]
+        holes = [False] * n_outer + [True] * n_holes
+        assert np.array_equal(_fill(rings, holes, 40), _fill_skimage(rings, holes, 40))
+
+
+def test_batch_draws_polygons_in_order():
+    rng = np.random.default_rng(2)
+    polygons = []
+    for value in range(1, 30):
+        n_outer = rng.integers(1, 3)
+        n_holes = rng.integers(0, 2)
+        rings = [_random_ring(rng, rng.uniform(0, 48, 2), 2, 12, value % 2 == 0) for _ in range(n_outer + n_holes)]
+        polygons.append((rings, [False] * n_outer + [True] * n_holes, value))
+
+    expected = np.zeros((48, 48), dtype=np.uint16)
+    for rings, holes, value in polygons:
+        expected[_mask_skimage(rings, holes, 48)] = value
+    assert np.array_equal(_fill_batch(polygons, 48), expected)
@@ -0,0 +1,230 @@
+import os
+import random
+
+import pytest
+
+from bossypaints.tasks import InMemoryTaskQueueStore, JSONFileTaskQueueStore, Task
+
+
+def _task(priority=0, assigned_to=None):
+    return Task(
+        collection="c",
+        experiment="e",
+        channel="ch",
+        resolution=0,
+        x_min=0,
+        x_max=64,
+        y_min=0,
+        y_max=64,
+        z_min=0,
+        z_max=8,
+        priority=priority,
+        assigned_to=assigned_to,
+    )
+
+
+@pytest.fixture
+def filename(tmp_path):
+    return str(tmp_path / "tasks.json")
+
+
+@pytest.fixture
+def store(filename):
+    store = JSONFileTaskQueueStore(filename)
+    store.compact_every = 10_000
+    return store
+
+
+def _mutate(store):
+    """Run one of each kind of mutation; returns the IDs of the tasks left."""
+    first = store.put(_task(1))
+    second = store.put(_task(2, "alice"))
+    third = store.put(_task(3))
+    store.assign(first, "bob")
+    store.update(third, store.get(third).model_copy(update={"priority": 7}))
+    store.delete(second)
+    return [first, third]
+
+
+def test_reload_replays_the_log(store, filename):
+    task_ids = _mutate(store)
+    assert os.path.getsize(f"{filename}.log") > 0
+
+    reloaded = JSONFileTaskQueueStore(filename)
+    assert reloaded.list() == store.list()
+    assert [task.id for task in reloaded.list()] == task_ids
+    assert reloaded.get(task_ids[0]).assigned_to == "bob"
+    assert reloaded.get(task_ids[1]).priority == 7
+
+
+def test_reload_ignores_a_partly_written_record(store, filename):
+    _mutate(store)
+    with open(f"{filename}.log", "ab") as f:
+        f.write(b'{"op":"put","id":"cut-short","task":{"collection"')
+
+    reloaded = JSONFileTaskQueueStore(filename)
+    assert reloaded.list() == store.list()
+    # Startup compaction drops the partial record from the log
+    assert os.path.getsize(f"{filename}.log") == 0
+
+
+def test_compaction_truncates_the_log(filename):
+    store = JSONFileTaskQueueStore(filename)
+    store.compact_every = 5
+    task_ids = [store.put(_task(i)) for i in range(4)]
+    assert os.path.getsize(f"{filename}.log") > 0
+
+    task_ids.append(store.put(_task(4)))
+    assert os.path.getsize(f"{filename}.log") == 0
+
+    reloaded = JSONFileTaskQueueStore(filename)
+    assert [task.id for task in reloaded.list()] == task_ids
+    assert reloaded.list() == store.list()
+
+
+def test_explicit_compaction_keeps_every_task(store, filename):
+    _mutate(store)
+    store.compact()
+    assert os.path.getsize(f"{filename}.log") == 0
+    assert JSONFileTaskQueueStore(filename).list() == store.list()
+
+
+def test_version_increases_on_every_mutation(store):
+    versions = [store.get_version()]
+    task_id = store.put(_task())
+    versions.append(store.get_version())
+    store.assign(task_id, "alice")
+    versions.append(store.get_version())
+    store.update(task_id, store.get(task_id).model_copy(update={"priority": 3}))
+    versions.append(store.get_version())
+    store.delete(task_id)
+    versions.append(store.get_version())
+    # Versions are "<epoch>-<count>" within one store
+    epochs, counts = zip(*(version.rsplit("-", 1) for version in versions))
+    assert len(set(epochs)) == 1
+    assert [int(count) for count in counts] == sorted(set(int(count) for count in counts))
+
+    # Reads and compaction leave it alone
+    store.list()
+    store.next_for_user("alice")
+    store.compact()
+    assert store.get_version() == versions[-1]
+
+
+def test_version_is_not_reused_across_reloads(store, filename):
+    store.put(_task())
+    version = store.get_version()
+    assert JSONFileTaskQueueStore(filename).get_version() != version
+
+
+def test_next_for_user_skips_reassigned_tasks(store):
+    high = store.put(_task(9, "alice"))
+    low = store.put(_task(1, "alice"))
+    assert store.next_for_user("alice").id == high
+
+    store.assign(high, "bob")
+    assert store.next_for_user("alice").id == low
+    assert store.next_for_user("bob").id == high
+
+    # Back again: the entry pushed now is the live one, not the stale one
+    store.assign(high, "alice")
+    assert store.next_for_user("alice").id == high
+    assert store.next_for_user("bob") is None
+
+
+def test_next_for_user_follows_priority_updates(store):
+    first = store.put(_task(5, "alice"))
+    second = store.put(_task(3, "alice"))
+    store.update(first, store.get(first).model_copy(update={"priority": 1}))
+    assert store.next_for_user("alice").id == second
+
+    store.update(first, store.get(first).model_copy(update={"priority": 8}))
+    assert store.next_for_user("alice").id == first
+
+
+def test_next_for_user_skips_deleted_tasks(store):
+    first = store.put(_task(5, "alice"))
+    second = store.put(_task(3, "alice"))
+    store.delete(first)
+    assert store.next_for_user("alice").id == second
+    store.delete(second)
+    assert store.next_for_user("alice") is None
+
+
+def test_ties_go_to_the_earliest_added_task(store, filename):
+    task_ids = [store.put(_task(4, "alice")) for _ in range(3)]
+    assert store.next_for_user("alice").id == task_ids[0]
+
+    # Updating or reassigning a task keeps its place in line
+    store.update(task_ids[0], store.get(task_ids[0]).model_copy(update={"priority": 4}))
+    store.assign(task_ids[1], "bob")
+    store.assign(task_ids[1], "alice")
+    assert store.next_for_user("alice").id == task_ids[0]
+    assert [task.id for task in store.list_for_user("alice")] == task_ids
+
+    store.delete(task_ids[0])
+    assert store.next_for_user("alice").id == task_ids[1]
+    assert JSONFileTaskQueueStore(filename).next_for_user("alice").id == task_ids[1]
+
+
+def test_unassigned_tasks_are_pooled_under_none(store):
+    # /tasks/next only hands out a user's own tasks, as before the heap; a user
+    # with none gets None, and unassigned tasks wait in the None pool
+    pooled = store.put(_task(2))
+    assigned = store.put(_task(5, "alice"))
+    assert store.next_for_user("bob") is None
+    assert [task.id for task in store.list_for_user(None)] == [pooled]
+
+    store.assign(assigned, None)
+    assert store.next_for_user("alice") is None
+    assert store.next_for_user(None).id == assigned
+    assert [task.id for task in store.list_for_user(None)] == [pooled, assigned]
+
+    store.assign(pooled, "bob")
+    assert store.next_for_user("bob").id == pooled
+    assert [task.id for task in store.list_for_user(None)] == [assigned]
+
+
+def test_heap_matches_a_linear_scan(filename):
+    """Check the heaps against TaskQueueStore's default next_for_user, a max() over list_for_user."""
+    rng = random.Random(0)
+    users = [None, "alice", "bob", "carol"]
+    store = JSONFileTaskQueueStore(filename)
+    store.compact_every = 97
+    expected = InMemoryTaskQueueStore()
+    # Parallel lists of each store's IDs for the same tasks
+    task_ids: list[str] = []
+    expected_ids: list[str] = []
+
+    for step in range(3000):
+        op = rng.random()
+        if op < 0.3 or not task_ids:
+            task = _task(rng.randrange(5), rng.choice(users))
+            task_ids.append(store.put(task))
+            expected_ids.append(expected.put(task))
+        elif op < 0.6:
+            i = rng.randrange(len(task_ids))
+            user = rng.choice(users)
+            store.assign(task_ids[i], user)
+            expected.assign(expected_ids[i], user)
+        elif op < 0.8:
+            i = rng.randrange(len(task_ids))
+            priority = rng.randrange(5)
+            store.update(task_ids[i], store.get(task_ids[i]).model_copy(update={"priority": priority}))
+            expected.update(expected_ids[i], expected.get(expected_ids[i]).model_copy(update={"priority": priority}))
+        elif op < 0.98:
+            i = rng.randrange(len(task_ids))
+            store.delete(task_ids.pop(i))
+            expected.delete(expected_ids.pop(i))
+        else:
+            store = JSONFileTaskQueueStore(filename)
+            store.compact_every = 97
+
+        to_expected = dict(zip(task_ids, expected_ids))
+        for user in users:
+            task = store.next_for_user(user)
+            expected_task = expected.next_for_user(user)
+            assert (to_expected[task.id] if task else None) == (expected_task.id if expected_task else None), step
+            assert [to_expected[t.id] for t in store.list_for_user(user)] == [
+                t.id for t in expected.list_for_user(user)
+            ]